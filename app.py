@@ -1,8 +1,12 @@
-import os, base64, json, re, time, sqlite3, secrets
-from collections import defaultdict
+import os, io, base64, binascii, bisect, glob, gzip, itertools, json, re, time, sqlite3, secrets, hashlib, threading, queue, shutil, tempfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from html import escape as _esc
-from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
-from openai import OpenAI
+from werkzeug.http import http_date
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response, stream_with_context, g
+import httpx
+from openai import OpenAI, DefaultHttpxClient, APIConnectionError
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,8 +16,7 @@ _pw      = os.environ.get("FORMA_PASSWORD", "")
 if not _api_key:
     print("WARNING: OPENAI_API_KEY is not set.")
 
-app    = Flask(__name__, static_folder="renderer", static_url_path="/static")
-client = OpenAI(api_key=_api_key or "missing")
+app = Flask(__name__, static_folder="renderer", static_url_path="/static")
 
 # ── Reasoning modes ────────────────────────────────────────────────────────────
 
@@ -39,57 +42,565 @@ _MAX_TOKENS = {"quick": 600, "deep": 1500, "expert": 2000}
 
 ALLOWED_EXT = {"png", "jpg", "jpeg", "webp", "gif"}
 MAX_BYTES   = 20 * 1024 * 1024
-RATE_LIMIT  = 15
+MAX_REQUEST_BYTES = int(os.environ.get("FORMA_MAX_REQUEST_MB", 512)) * 1024 * 1024  # whole request body
+RATE_LIMIT  = 15                                                      # /analyze requests per IP per minute
+BATCH_RATE_LIMIT = int(os.environ.get("FORMA_BATCH_RATE_LIMIT", 60))  # /batch images per IP per minute
+RATE_BACKEND = os.environ.get("FORMA_RATE_BACKEND", "memory")         # "sqlite" to share limits across workers
+BATCH_CONCURRENCY = max(1, int(os.environ.get("FORMA_BATCH_CONCURRENCY", 4)))
+JOB_WORKERS = max(1, int(os.environ.get("FORMA_JOB_WORKERS", BATCH_CONCURRENCY)))  # background job threads
+JOB_MAX_ATTEMPTS = 3
+JOB_LEASE   = 600  # seconds before a "running" job item is considered abandoned and resumed
+JOB_SWEEP   = 60   # seconds between lease sweeps
+CACHE_SIZE  = int(os.environ.get("FORMA_CACHE_SIZE", 512))       # in-process entries
+CACHE_TTL   = int(os.environ.get("FORMA_CACHE_TTL", 7 * 86400))  # seconds
+IMAGE_QUALITY = int(os.environ.get("FORMA_IMAGE_QUALITY", 85))  # JPEG quality for upstream copies
+THUMB_SIZE  = 256  # longest side of stored thumbnails, px
+SESSION_TTL = int(os.environ.get("FORMA_SESSION_TTL", 86400))            # seconds idle before a session expires
+SESSION_MAX_TOKENS = int(os.environ.get("FORMA_SESSION_TOKENS", 8000))  # history kept per session, approx tokens
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+EXCERPT_CHARS = 240  # answer characters in list responses unless ?fields=answer
+COMPRESS_MIN  = int(os.environ.get("FORMA_COMPRESS_MIN", 1024))  # smallest response body compressed, bytes
+IMPORT_BATCH  = int(os.environ.get("FORMA_IMPORT_BATCH", 1000))               # /import rows per transaction
+IMPORT_MAX_BYTES = int(os.environ.get("FORMA_IMPORT_MAX_MB", 8192)) * 1024 * 1024  # /import body limit
+
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
+
+# Vision detail per mode, and the largest (long side, short side) the model
+# looks at for each detail level. Anything bigger is wasted upload.
+_IMAGE_DETAIL   = {"quick": "low", "deep": "high", "expert": "high"}
+_IMAGE_MAX_SIDE = {"low": (512, 512), "high": (2048, 768)}
+
+# ── Metrics ────────────────────────────────────────────────────────────────────
+
+# In-process counters and histograms, exported by GET /metrics in Prometheus
+# text format. FORMA_METRICS=0 turns recording and the endpoint off. Each
+# worker process reports its own numbers.
+
+METRICS = os.environ.get("FORMA_METRICS", "1") != "0"
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_RATE_BUCKETS    = (5, 10, 20, 40, 60, 80, 100, 150, 200, 300)
+
+_metrics: dict = {}  # name -> [kind, help, buckets, {label tuple: value}]
+_metrics_lock = threading.Lock()
+
+def _metric(name: str, kind: str, help: str, buckets=None):
+    _metrics[name] = [kind, help, buckets, {}]
+
+_metric("forma_http_requests_total",           "counter",   "Requests by route, method and status.")
+_metric("forma_http_request_duration_seconds", "histogram", "Time to response headers by route.", _LATENCY_BUCKETS)
+_metric("forma_analyze_ttft_seconds",          "histogram", "/analyze time to first upstream token.", _LATENCY_BUCKETS)
+_metric("forma_analyze_tokens_per_second",     "histogram", "/analyze streaming rate after the first token.", _RATE_BUCKETS)
+_metric("forma_analyze_tokens_total",          "counter",   "Streamed /analyze chunks (about one token each).")
+_metric("forma_upstream_seconds",              "histogram", "Non-streaming upstream call time.", _LATENCY_BUCKETS)
+_metric("forma_upstream_errors_total",         "counter",   "Upstream failures by call and exception type.")
+_metric("forma_db_transaction_seconds",        "histogram", "Time a pooled SQLite connection is held.", _LATENCY_BUCKETS)
+_metric("forma_db_connections_opened_total",   "counter",   "SQLite connections opened because the pool was empty.")
+_metric("forma_pdf_render_seconds",            "histogram", "PDF render time.", _LATENCY_BUCKETS)
+_metric("forma_pdf_cache_total",               "counter",   "PDF export cache hits and misses.")
+_metric("forma_batch_queue_depth",             "gauge",     "Background job items queued and running.")
+_metric("forma_coalesced_total",               "counter",   "Requests that joined an identical in-flight call.")
+_metric("forma_upstream_retries_total",        "counter",   "Upstream calls retried after a retryable failure.")
+_metric("forma_upstream_hedges_total",         "counter",   "Hedged stream requests sent, and how many won.")
+_metric("forma_upstream_breaker_open",         "gauge",     "1 while the upstream circuit breaker refuses calls.")
+
+def _inc(name: str, value: float = 1, **labels):
+    if not METRICS:
+        return
+    key = tuple(sorted(labels.items()))
+    with _metrics_lock:
+        series = _metrics[name][3]
+        series[key] = series.get(key, 0) + value
+
+def _observe(name: str, value: float, **labels):
+    if not METRICS:
+        return
+    key, buckets = tuple(sorted(labels.items())), _metrics[name][2]
+    with _metrics_lock:
+        series = _metrics[name][3]
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = [[0] * (len(buckets) + 1), 0.0]  # per-bucket counts (+Inf last), sum
+        hist[0][bisect.bisect_left(buckets, value)] += 1
+        hist[1] += value
+
+def _label_str(key, extra=()) -> str:
+    pairs = [*key, *extra]
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+def _render_metrics() -> str:
+    out = []
+    with _metrics_lock:
+        for name, (kind, help, buckets, series) in _metrics.items():
+            out += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for key, value in series.items():
+                if kind != "histogram":
+                    out.append(f"{name}{_label_str(key)} {value}")
+                    continue
+                counts, total, cum = value[0], value[1], 0
+                for bound, n in zip((*buckets, "+Inf"), counts):
+                    cum += n
+                    out.append(f"{name}_bucket{_label_str(key, [('le', bound)])} {cum}")
+                out += [f"{name}_sum{_label_str(key)} {total}", f"{name}_count{_label_str(key)} {cum}"]
+    return "\n".join(out) + "\n"
 
 # ── SQLite ─────────────────────────────────────────────────────────────────────
 
 # Use /tmp on Vercel (read-only filesystem), local dir otherwise
 _is_vercel = bool(os.environ.get("VERCEL"))
-DB_PATH = "/tmp/forma.db" if _is_vercel else os.path.join(os.path.dirname(__file__), "forma.db")
-
-def _get_db():
-    db = sqlite3.connect(DB_PATH)
+DB_PATH = os.environ.get("FORMA_DB_PATH") or (
+    "/tmp/forma.db" if _is_vercel else os.path.join(os.path.dirname(__file__), "forma.db"))
+DB_POOL_SIZE = int(os.environ.get("FORMA_DB_POOL", 8))  # idle connections kept open
+
+_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA synchronous=NORMAL",    # safe under WAL; fsync only at checkpoints
+    "PRAGMA cache_size=-16000",     # 16 MB page cache per connection
+    "PRAGMA mmap_size=134217728",   # 128 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+)
+_idle_dbs: queue.LifoQueue = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def _connect():
+    db = sqlite3.connect(DB_PATH, timeout=5, check_same_thread=False)
     db.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        db.execute(pragma)
     return db
 
+@contextmanager
+def _get_db(immediate=False):
+    """Borrow a pooled connection for one transaction.
+
+    Commits on success and rolls back on error, then returns the connection
+    to the pool (or closes it if the pool is already full). Pass
+    immediate=True for read-then-write transactions so the write lock is
+    taken up front instead of failing on a stale WAL snapshot.
+    """
+    start = time.perf_counter()
+    try:
+        db = _idle_dbs.get_nowait()
+    except queue.Empty:
+        db = _connect()
+        _inc("forma_db_connections_opened_total")
+    try:
+        with db:
+            if immediate:
+                db.execute("BEGIN IMMEDIATE")
+            yield db
+    finally:
+        _observe("forma_db_transaction_seconds", time.perf_counter() - start)
+        try:
+            _idle_dbs.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+# Columns in insert order; image_b64 is legacy and no longer written
+_ANALYSIS_INSERT = ("INSERT INTO analyses (id,question,answer,mode,image_hash,project_id,created_at) "
+                    "VALUES (?,?,?,?,?,?,?)")
+
+# ── Schema migrations ──────────────────────────────────────────────────────────
+
+# Each step runs once, in order, inside its own transaction; the applied
+# version is kept in PRAGMA user_version. Add schema changes by appending a
+# step to _MIGRATIONS, never by editing an earlier one.
+
+def _m_base(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS analyses (
+            id         TEXT    PRIMARY KEY,
+            question   TEXT    NOT NULL,
+            answer     TEXT    NOT NULL,
+            mode       TEXT    NOT NULL,
+            image_b64  TEXT,
+            project_id TEXT,
+            created_at INTEGER NOT NULL
+        )""")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS projects (
+            id         TEXT    PRIMARY KEY,
+            name       TEXT    NOT NULL,
+            emoji      TEXT    NOT NULL DEFAULT '📁',
+            created_at INTEGER NOT NULL
+        )""")
+
+def _m_response_cache(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key        TEXT    PRIMARY KEY,
+            answer     TEXT    NOT NULL,
+            created_at INTEGER NOT NULL
+        )""")
+
+def _m_images(db):
+    """Move legacy base64 image_b64 values into the content-addressed images table."""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            hash       TEXT    PRIMARY KEY,
+            mime       TEXT    NOT NULL,
+            data       BLOB    NOT NULL,
+            thumb      BLOB,
+            created_at INTEGER NOT NULL
+        )""")
+    cols = {r["name"] for r in db.execute("PRAGMA table_info(analyses)")}
+    if "image_hash" not in cols:
+        db.execute("ALTER TABLE analyses ADD COLUMN image_hash TEXT")
+    while True:
+        rows = db.execute("SELECT id, image_b64 FROM analyses WHERE image_b64 IS NOT NULL LIMIT 200").fetchall()
+        if not rows:
+            return
+        for r in rows:
+            digest = None
+            try:
+                rec = _image_record(base64.b64decode(r["image_b64"]))
+                if rec:
+                    _store_images(db, [rec])
+                    digest = rec[0]
+            except ValueError:
+                pass
+            db.execute("UPDATE analyses SET image_hash=?, image_b64=NULL WHERE id=?", (digest, r["id"]))
+
+def _m_fts(db):
+    """Create the FTS5 index over question/answer, kept in sync by triggers.
+
+    analyses_fts is an external-content table sharing analyses' rowid, so the
+    text is not stored twice. If this SQLite build lacks FTS5, /search falls
+    back to LIKE scans.
+    """
+    try:
+        db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS analyses_fts USING fts5(
+                question, answer, content='analyses', content_rowid='rowid'
+            )""")
+    except sqlite3.OperationalError:
+        print("WARNING: SQLite FTS5 unavailable; /search will use LIKE scans.")
+        return
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS analyses_fts_ai AFTER INSERT ON analyses BEGIN
+            INSERT INTO analyses_fts(rowid, question, answer)
+            VALUES (new.rowid, new.question, new.answer);
+        END""")
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS analyses_fts_ad AFTER DELETE ON analyses BEGIN
+            INSERT INTO analyses_fts(analyses_fts, rowid, question, answer)
+            VALUES ('delete', old.rowid, old.question, old.answer);
+        END""")
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS analyses_fts_au AFTER UPDATE OF question, answer ON analyses BEGIN
+            INSERT INTO analyses_fts(analyses_fts, rowid, question, answer)
+            VALUES ('delete', old.rowid, old.question, old.answer);
+            INSERT INTO analyses_fts(rowid, question, answer)
+            VALUES (new.rowid, new.question, new.answer);
+        END""")
+    db.execute("INSERT INTO analyses_fts(analyses_fts) VALUES ('rebuild')")
+
+def _m_indexes(db):
+    db.execute("CREATE INDEX IF NOT EXISTS idx_analyses_project_created ON analyses(project_id, created_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_analyses_created ON analyses(created_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_analyses_mode_created ON analyses(mode, created_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_analyses_image_hash ON analyses(image_hash)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created ON response_cache(created_at)")
+
+# Derived project fields. Triggers apply this after an analysis joins (+1) or
+# leaves (-1) a project, so GET /projects is a single indexed read.
+_PROJECT_REFRESH = """
+    UPDATE projects SET
+        analysis_count  = {count},
+        last_activity   = COALESCE((SELECT MAX(created_at) FROM analyses
+                                    WHERE project_id = projects.id), created_at),
+        last_image_hash = (SELECT image_hash FROM analyses
+                           WHERE project_id = projects.id AND image_hash IS NOT NULL
+                           ORDER BY created_at DESC LIMIT 1)"""
+
+def _m_project_counters(db):
+    """Keep analysis_count, last_activity and last_image_hash on projects current via triggers."""
+    cols = {r["name"] for r in db.execute("PRAGMA table_info(projects)")}
+    if "analysis_count" not in cols:
+        db.execute("ALTER TABLE projects ADD COLUMN analysis_count INTEGER NOT NULL DEFAULT 0")
+    if "last_activity" not in cols:
+        db.execute("ALTER TABLE projects ADD COLUMN last_activity INTEGER")
+    if "last_image_hash" not in cols:
+        db.execute("ALTER TABLE projects ADD COLUMN last_image_hash TEXT")
+    join  = _PROJECT_REFRESH.format(count="analysis_count + 1") + " WHERE id = new.project_id;"
+    leave = _PROJECT_REFRESH.format(count="analysis_count - 1") + " WHERE id = old.project_id;"
+    db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS projects_count_ai AFTER INSERT ON analyses
+        WHEN new.project_id IS NOT NULL BEGIN {join} END""")
+    db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS projects_count_ad AFTER DELETE ON analyses
+        WHEN old.project_id IS NOT NULL BEGIN {leave} END""")
+    db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS projects_count_au AFTER UPDATE OF project_id ON analyses
+        WHEN old.project_id IS NOT new.project_id BEGIN {leave} {join} END""")
+    db.execute(_PROJECT_REFRESH.format(
+        count="(SELECT COUNT(*) FROM analyses WHERE project_id = projects.id)"))
+
+def _m_rate_limits(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key        TEXT    PRIMARY KEY,
+            window     INTEGER NOT NULL,
+            curr       REAL    NOT NULL,
+            prev       REAL    NOT NULL
+        )""")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_window ON rate_limits(window)")
+
+def _m_jobs(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id          TEXT    PRIMARY KEY,
+            mode        TEXT    NOT NULL,
+            project_id  TEXT,
+            total       INTEGER NOT NULL,
+            pending     INTEGER NOT NULL,
+            done        INTEGER NOT NULL DEFAULT 0,
+            failed      INTEGER NOT NULL DEFAULT 0,
+            seq         INTEGER NOT NULL DEFAULT 0,
+            created_at  INTEGER NOT NULL,
+            finished_at INTEGER
+        )""")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS job_items (
+            job_id      TEXT    NOT NULL,
+            idx         INTEGER NOT NULL,
+            filename    TEXT,
+            question    TEXT,
+            image_hash  TEXT,
+            status      TEXT    NOT NULL,
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            claimed_at  REAL,
+            analysis_id TEXT,
+            error       TEXT,
+            seq         INTEGER,
+            PRIMARY KEY (job_id, idx)
+        )""")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_job_items_job_seq ON job_items(job_id, seq)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_job_items_status ON job_items(status)")
+
+def _m_sessions(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            id          TEXT    PRIMARY KEY,
+            image_hash  TEXT    NOT NULL,
+            turns       TEXT    NOT NULL,
+            tokens      INTEGER NOT NULL,
+            created_at  INTEGER NOT NULL,
+            updated_at  INTEGER NOT NULL
+        )""")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at)")
+
+def _m_project_versions(db):
+    """projects.version changes whenever the project's set of analyses does (keys the PDF cache)."""
+    cols = {r["name"] for r in db.execute("PRAGMA table_info(projects)")}
+    if "version" not in cols:
+        db.execute("ALTER TABLE projects ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    bump = "UPDATE projects SET version = version + 1 WHERE id IN ({ids});"
+    db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS projects_version_ai AFTER INSERT ON analyses
+        WHEN new.project_id IS NOT NULL BEGIN {bump.format(ids="new.project_id")} END""")
+    db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS projects_version_ad AFTER DELETE ON analyses
+        WHEN old.project_id IS NOT NULL BEGIN {bump.format(ids="old.project_id")} END""")
+    db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS projects_version_au AFTER UPDATE ON analyses
+        BEGIN {bump.format(ids="old.project_id, new.project_id")} END""")
+
+def _m_share_pages(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS share_pages (
+            id          TEXT    PRIMARY KEY,
+            html        BLOB    NOT NULL,
+            etag        TEXT    NOT NULL,
+            version     TEXT    NOT NULL,
+            created_at  INTEGER NOT NULL
+        )""")
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS share_pages_ad AFTER DELETE ON analyses
+        BEGIN DELETE FROM share_pages WHERE id = old.id; END""")
+
+def _m_project_image_index(db):
+    """Partial index for last_image_hash in _PROJECT_REFRESH. Without it every insert
+    into a project scans past all of that project's image-less analyses, which makes
+    bulk imports quadratic.
+    """
+    db.execute("CREATE INDEX IF NOT EXISTS idx_analyses_project_image ON analyses(project_id, created_at) "
+               "WHERE image_hash IS NOT NULL")
+
+def _m_job_keys(db):
+    """jobs.key_hash: SHA-256 of the caller's X-OpenAI-Key, NULL for jobs on the server key."""
+    cols = {r["name"] for r in db.execute("PRAGMA table_info(jobs)")}
+    if "key_hash" not in cols:
+        db.execute("ALTER TABLE jobs ADD COLUMN key_hash TEXT")
+
+_MIGRATIONS = [_m_base, _m_response_cache, _m_images, _m_fts, _m_indexes, _m_project_counters,
+               _m_rate_limits, _m_jobs, _m_sessions, _m_project_versions, _m_share_pages,
+               _m_project_image_index, _m_job_keys]
+
+_fts = False  # True once the FTS5 index over analyses is available
+
 def _init_db():
-    with _get_db() as db:
-        db.executescript("""
-            CREATE TABLE IF NOT EXISTS analyses (
-                id         TEXT    PRIMARY KEY,
-                question   TEXT    NOT NULL,
-                answer     TEXT    NOT NULL,
-                mode       TEXT    NOT NULL,
-                image_b64  TEXT,
-                project_id TEXT,
-                created_at INTEGER NOT NULL
-            );
-            CREATE TABLE IF NOT EXISTS projects (
-                id         TEXT    PRIMARY KEY,
-                name       TEXT    NOT NULL,
-                emoji      TEXT    NOT NULL DEFAULT '📁',
-                created_at INTEGER NOT NULL
-            );
-        """)
+    """Switch the database to WAL and apply pending migrations.
+
+    Uses a private connection so no pooled connection outlives a fork of a
+    preloading server. BEGIN IMMEDIATE serializes workers starting together.
+    """
+    global _fts
+    db = _connect()
+    try:
+        db.execute("PRAGMA journal_mode=WAL")
+        for version, step in enumerate(_MIGRATIONS, 1):
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if db.execute("PRAGMA user_version").fetchone()[0] < version:
+                    step(db)
+                    db.execute(f"PRAGMA user_version={version}")
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+        _fts = bool(db.execute("SELECT 1 FROM sqlite_master WHERE name='analyses_fts'").fetchone())
+    finally:
+        db.close()
+
+# ── Image store ────────────────────────────────────────────────────────────────
+
+# Analysis images are stored once per content hash as binary BLOBs, with a
+# small JPEG thumbnail, and served from /images/<hash>.
+
+def _sniff_mime(data: bytes):
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and len(data) >= 12 and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def _make_thumb(raw: bytes, size: int = THUMB_SIZE, quality: int = 70):
+    """JPEG thumbnail bytes, or None if Pillow is missing or decoding fails."""
+    try:
+        from PIL import Image, ImageOps
+
+        with Image.open(io.BytesIO(raw)) as img:
+            img.draft("RGB", (size, size))
+            frame = img.convert("RGBA")
+            ImageOps.exif_transpose(frame, in_place=True)
+            frame.thumbnail((size, size))
+            flat = Image.new("RGB", frame.size, "white")
+            flat.paste(frame, mask=frame.getchannel("A"))
+            out = io.BytesIO()
+            flat.save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+    except Exception:
+        return None
+
+def _image_record(raw: bytes, mime: str = None, thumb: bool = True, digest: str = None):
+    """Build an images row (hash, mime, data, thumb, created_at), or None if raw isn't an image.
+
+    thumb=False defers the thumbnail to whoever processes the image later.
+    """
+    mime = _sniff_mime(raw) or mime
+    if not raw or not mime:
+        return None
+    return (digest or hashlib.sha256(raw).hexdigest(), mime, raw,
+            _make_thumb(raw) if thumb else None, int(time.time()))
+
+def _store_images(db, records):
+    records = [r for r in records if r]
+    if records:  # an empty executemany would still open a read snapshot before our write
+        db.executemany("INSERT OR IGNORE INTO images VALUES (?,?,?,?,?)", records)
+
 _init_db()
 
 # ── Rate limiter ───────────────────────────────────────────────────────────────
 
-_rate: dict = defaultdict(list)
-_uses_log: list = []  # global per-minute log for stats
-
-def _is_limited(ip: str) -> bool:
-    now = time.time()
-    _rate[ip] = [t for t in _rate[ip] if now - t < 60]
-    if len(_rate[ip]) >= RATE_LIMIT:
+# Sliding-window counters: each key keeps the count for the current and the
+# previous 60s window, and the previous one is weighted by how much of it
+# still overlaps the last minute. Updates are O(1) and idle keys are evicted.
+
+RATE_WINDOW   = 60
+RATE_MAX_KEYS = 100_000  # memory backend hard cap
+
+def _window_estimate(state, now):
+    """Roll a (window, curr, prev) state forward to now. Returns (state, estimate)."""
+    win = int(now // RATE_WINDOW)
+    w, curr, prev = state or (win, 0.0, 0.0)
+    if w != win:
+        prev, curr = (curr if w == win - 1 else 0.0), 0.0
+    overlap = 1 - (now % RATE_WINDOW) / RATE_WINDOW
+    return (win, curr, prev), prev * overlap + curr
+
+class _MemoryLimiter:
+    """Per-process counters in an LRU-ordered dict."""
+
+    def __init__(self):
+        self._keys: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, cost=1):
+        now = time.time()
+        with self._lock:
+            (win, curr, prev), est = _window_estimate(self._keys.get(key), now)
+            allowed = est + cost <= limit
+            self._keys[key] = (win, curr + cost if allowed else curr, prev)
+            self._keys.move_to_end(key)
+            self._evict(win)
+        return allowed
+
+    def estimate(self, key):
+        with self._lock:
+            return _window_estimate(self._keys.get(key), time.time())[1]
+
+    def _evict(self, win):
+        # Least recently used first; anything two windows old counts for nothing
+        while self._keys:
+            oldest, state = next(iter(self._keys.items()))
+            if state[0] >= win - 1 and len(self._keys) <= RATE_MAX_KEYS:
+                break
+            del self._keys[oldest]
+
+class _SqliteLimiter:
+    """Counters in the rate_limits table, so limits hold across worker processes."""
+
+    def __init__(self):
+        self._last_sweep = 0.0
+
+    def hit(self, key, limit, cost=1):
+        now = time.time()
+        with _get_db(immediate=True) as db:
+            row = db.execute("SELECT window, curr, prev FROM rate_limits WHERE key=?", (key,)).fetchone()
+            (win, curr, prev), est = _window_estimate(tuple(row) if row else None, now)
+            allowed = est + cost <= limit
+            db.execute("INSERT OR REPLACE INTO rate_limits VALUES (?,?,?,?)",
+                       (key, win, curr + cost if allowed else curr, prev))
+            if now - self._last_sweep > RATE_WINDOW:
+                self._last_sweep = now
+                db.execute("DELETE FROM rate_limits WHERE window < ?", (win - 1,))
+        return allowed
+
+    def estimate(self, key):
+        with _get_db() as db:
+            row = db.execute("SELECT window, curr, prev FROM rate_limits WHERE key=?", (key,)).fetchone()
+        return _window_estimate(tuple(row) if row else None, time.time())[1]
+
+_limiter = _SqliteLimiter() if RATE_BACKEND == "sqlite" else _MemoryLimiter()
+
+def _client_ip(req) -> str:
+    return (req.headers.get("X-Forwarded-For", "") or req.remote_addr or "").split(",")[0].strip()
+
+def _is_limited(route: str, ip: str, limit: int, cost: int = 1) -> bool:
+    if not _limiter.hit(f"{route}:{ip}", limit, cost):
         return True
-    _rate[ip].append(now)
-    _uses_log.append(now)
+    _limiter.hit("uses", float("inf"), cost)  # global per-minute count for stats
     return False
 
 def _uses_this_minute() -> int:
-    now = time.time()
-    return len([t for t in _uses_log if now - t < 60])
+    return round(_limiter.estimate("uses"))
 
 # ── Auth ───────────────────────────────────────────────────────────────────────
 
@@ -98,95 +609,738 @@ def _authed(req) -> bool:
         return True
     return req.headers.get("X-Forma-Key", "") == _pw
 
+# ── OpenAI clients ─────────────────────────────────────────────────────────────
+
+# All clients share one httpx connection pool. The key travels in a request
+# header, so a caller bringing their own key (X-OpenAI-Key) reuses warm TLS
+# connections. Per-key client objects live in a small LRU keyed by a hash of
+# the key, built once per key instead of once per request.
+
+CLIENT_POOL_SIZE = int(os.environ.get("FORMA_CLIENT_POOL", 64))   # per-request-key clients kept
+CLIENT_IDLE      = int(os.environ.get("FORMA_CLIENT_IDLE", 900))  # seconds before an unused one is dropped
+
+try:
+    import h2  # noqa: F401  -- lets httpx negotiate HTTP/2
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=120)
+
+class _ClientPool:
+    """Bounded LRU of API clients keyed by SHA-256 of the key, with idle eviction.
+
+    Evicted clients are only dropped, never closed: they share the transport
+    with every other client, and a job may still hold one.
+    """
+
+    def __init__(self, factory, size: int, idle: int):
+        self._factory = factory
+        self._size    = max(1, size)
+        self._idle    = idle
+        self._clients: OrderedDict = OrderedDict()  # key hash -> (client, last used)
+        self._lock    = threading.Lock()
+        self._stats   = {"hits": 0, "misses": 0, "evicted": 0}
+
+    def get(self, key: str):
+        digest = _key_hash(key)
+        now    = time.monotonic()
+        with self._lock:
+            entry = self._clients.pop(digest, None)
+            while self._clients:
+                _, used = next(iter(self._clients.values()))
+                if now - used < self._idle:
+                    break
+                self._clients.popitem(last=False)
+                self._stats["evicted"] += 1
+            if entry:
+                self._stats["hits"] += 1
+                ai = entry[0]
+            else:
+                self._stats["misses"] += 1
+                ai = self._factory(key)
+            self._clients[digest] = (ai, now)
+            if len(self._clients) > self._size:
+                self._clients.popitem(last=False)
+                self._stats["evicted"] += 1
+        return ai
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "clients": len(self._clients),
+                    "max_clients": self._size, "http2": _HTTP2}
+
+_http    = DefaultHttpxClient(limits=_HTTP_LIMITS, http2=_HTTP2)
+# max_retries=0: retries are ours (see Upstream resilience), so they share the breaker
+client   = OpenAI(api_key=_api_key or "missing", http_client=_http, max_retries=0)
+_clients = _ClientPool(lambda key: OpenAI(api_key=key, http_client=_http, max_retries=0),
+                       CLIENT_POOL_SIZE, CLIENT_IDLE)
+
+def _key_hash(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
 def _get_client(req):
     """Return an OpenAI client, preferring a per-request key from X-OpenAI-Key header."""
     req_key = req.headers.get("X-OpenAI-Key", "").strip()
     if req_key:
-        return OpenAI(api_key=req_key)
+        return _clients.get(req_key)
     return client
 
+def _request_key_hash(req):
+    """Hash of the request's own X-OpenAI-Key, or None when it uses the server key."""
+    req_key = req.headers.get("X-OpenAI-Key", "").strip()
+    return _key_hash(req_key) if req_key else None
+
+# ── Upstream resilience ────────────────────────────────────────────────────────
+
+# Every upstream call gets a per-mode latency budget: UPSTREAM_TTFT to start
+# answering plus _MAX_TOKENS[mode] at UPSTREAM_MIN_RATE tokens/sec. Retryable
+# failures (connection errors, timeouts, 408/409/429/5xx) are retried with
+# jittered backoff, streams only before their first token. With
+# FORMA_HEDGE_PERCENTILE set, a stream still silent past that percentile of
+# recent first-token times gets a second identical request and the first to
+# answer wins. A circuit breaker opens after BREAKER_FAILURES consecutive
+# retryable failures and fails calls fast for BREAKER_COOLDOWN seconds, then
+# lets one probe through. The server key has one breaker; each caller's own
+# key (X-OpenAI-Key) gets another, so one caller's failing key can't shut the
+# service for everyone. Quota and auth errors belong to a key, not the
+# upstream, so they are never retried or counted.
+
+UPSTREAM_TTFT     = float(os.environ.get("FORMA_UPSTREAM_TTFT", 15))      # seconds to first token (or reply)
+UPSTREAM_MIN_RATE = float(os.environ.get("FORMA_UPSTREAM_MIN_RATE", 40))  # tokens/sec the budget allows for
+UPSTREAM_RETRIES  = int(os.environ.get("FORMA_UPSTREAM_RETRIES", 2))      # extra attempts after the first
+UPSTREAM_BACKOFF  = float(os.environ.get("FORMA_UPSTREAM_BACKOFF", 0.5))  # base delay, doubled per attempt
+HEDGE_PERCENTILE  = float(os.environ.get("FORMA_HEDGE_PERCENTILE", 0))    # 0 disables hedging
+HEDGE_MIN         = float(os.environ.get("FORMA_HEDGE_MIN", 1.0))         # never hedge sooner, seconds
+HEDGE_SAMPLES     = 20   # first-token times needed before hedging starts
+BREAKER_FAILURES  = int(os.environ.get("FORMA_BREAKER_FAILURES", 5))      # 0 disables the breaker
+BREAKER_COOLDOWN  = float(os.environ.get("FORMA_BREAKER_COOLDOWN", 30))   # seconds open before a probe
+
+_BUDGETS = {mode: UPSTREAM_TTFT + n / UPSTREAM_MIN_RATE for mode, n in _MAX_TOKENS.items()}
+
+_ttft_samples = deque(maxlen=200)  # recent per-attempt first-token times, for the hedge threshold
+_upstream_lock  = threading.Lock()
+_upstream_stats = {"retries": 0, "hedges": 0, "hedge_wins": 0, "rejected": 0}
+_hedge_pool = ThreadPoolExecutor(max_workers=_HTTP_LIMITS.max_connections, thread_name_prefix="forma-hedge")
+
+class _CircuitOpen(Exception):
+    pass
+
+class _Breaker:
+    """Consecutive-failure circuit breaker: closed -> open -> half-open (one probe) -> closed."""
+
+    def __init__(self, failures: int, cooldown: float):
+        self._failures = failures
+        self._cooldown = cooldown
+        self._lock     = threading.Lock()
+        self._state    = "closed"
+        self._fails    = 0
+        self._since    = 0.0   # when it opened, or when the probe was let through
+        self._opened   = 0
+
+    def _elapsed(self) -> float:
+        return time.monotonic() - self._since
+
+    def is_open(self) -> bool:
+        """True while calls would be refused. Does not take the half-open probe."""
+        with self._lock:
+            return self._state != "closed" and self._elapsed() < self._cooldown
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == "closed" or self._failures <= 0:
+                return True
+            if self._elapsed() < self._cooldown:
+                return False
+            # Cooldown over (or the last probe never reported back): let one call through
+            self._state, self._since = "half-open", time.monotonic()
+            return True
+
+    def success(self):
+        with self._lock:
+            self._state, self._fails = "closed", 0
+
+    def failure(self):
+        with self._lock:
+            self._fails += 1
+            if self._failures > 0 and (self._state == "half-open" or self._fails >= self._failures):
+                if self._state != "open":
+                    self._opened += 1
+                self._state, self._since = "open", time.monotonic()
+
+    def retry_after(self) -> int:
+        with self._lock:
+            return max(1, int(self._cooldown - self._elapsed() + 0.999))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self._state, "consecutive_failures": self._fails, "opened": self._opened,
+                    "failures_to_open": self._failures, "cooldown": self._cooldown}
+
+_breaker = _Breaker(BREAKER_FAILURES, BREAKER_COOLDOWN)  # the server key's
+_key_breakers: OrderedDict = OrderedDict()  # caller key hash -> _Breaker, LRU like _clients
+
+def _breaker_for(ai) -> _Breaker:
+    """The breaker for the key ai (sync or async client) calls with."""
+    if ai.api_key == client.api_key:
+        return _breaker
+    digest = _key_hash(ai.api_key)
+    with _upstream_lock:
+        breaker = _key_breakers.pop(digest, None) or _Breaker(BREAKER_FAILURES, BREAKER_COOLDOWN)
+        _key_breakers[digest] = breaker
+        while len(_key_breakers) > CLIENT_POOL_SIZE:
+            _key_breakers.popitem(last=False)
+    return breaker
+
+def _circuit_open_error(breaker: _Breaker = _breaker) -> _CircuitOpen:
+    with _upstream_lock:
+        _upstream_stats["rejected"] += 1
+    return _CircuitOpen(f"The AI service is failing; not calling it for {breaker.retry_after()}s.")
+
+def _upstream_timeout(mode: str, stream: bool) -> httpx.Timeout:
+    """Per-mode httpx timeout. For streams the read timeout bounds the wait for
+    each chunk, the first included; the whole budget is checked while reading.
+    """
+    budget = _BUDGETS.get(mode, _BUDGETS["deep"])
+    return httpx.Timeout(budget, connect=5.0, read=UPSTREAM_TTFT if stream else budget)
+
+def _retryable(exc: Exception) -> bool:
+    if isinstance(exc, (APIConnectionError, TimeoutError, httpx.TransportError)):
+        return True
+    status = getattr(exc, "status_code", None)
+    if status == 429 and getattr(exc, "code", None) == "insufficient_quota":
+        return False  # the key is out of credit; waiting won't help
+    return status in (408, 409, 429) or (status or 0) >= 500
+
+def _backoff(attempt: int, exc: Exception) -> float:
+    """Full-jitter exponential backoff, stretched to any Retry-After the upstream sent."""
+    delay = UPSTREAM_BACKOFF * 2 ** attempt * secrets.randbelow(1001) / 1000
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        delay = max(delay, min(float(headers.get("retry-after", 0)), 10.0))
+    except ValueError:
+        pass
+    return delay
+
+def _upstream_attempt(call: str, attempt: int, exc: Exception, stop=None, breaker: _Breaker = _breaker):
+    """Record a failed attempt and return the delay before retrying it, or raise."""
+    retry = _retryable(exc)
+    if retry:
+        breaker.failure()
+    else:
+        breaker.success()  # a 4xx still means the upstream is up
+    if not retry or attempt >= UPSTREAM_RETRIES or (stop and stop()) or not breaker.allow():
+        raise exc
+    with _upstream_lock:
+        _upstream_stats["retries"] += 1
+    _inc("forma_upstream_retries_total", call=call)
+    return _backoff(attempt, exc)
+
+def _with_retries(call: str, fn, stop=None, breaker: _Breaker = _breaker):
+    """Run fn() under breaker, retrying retryable failures. stop() ends retries early."""
+    if not breaker.allow():
+        raise _circuit_open_error(breaker)
+    for attempt in itertools.count():
+        try:
+            result = fn()
+        except Exception as exc:
+            time.sleep(_upstream_attempt(call, attempt, exc, stop, breaker))
+            continue
+        breaker.success()
+        return result
+
+def _hedge_after():
+    """Seconds without a first token before hedging, or None when hedging is off."""
+    if HEDGE_PERCENTILE <= 0:
+        return None
+    with _upstream_lock:
+        samples = sorted(_ttft_samples)
+    if len(samples) < HEDGE_SAMPLES:
+        return None
+    return max(HEDGE_MIN, samples[int(HEDGE_PERCENTILE / 100 * (len(samples) - 1))])
+
+def _first_token(ai, kwargs: dict):
+    """Open a streaming completion and read up to its first content chunk.
+
+    Returns (stream, chunks), where chunks yields the whole response from the
+    start. The stream is closed if this fails.
+    """
+    started = time.perf_counter()
+    stream  = ai.chat.completions.create(**kwargs)
+    try:
+        it, head = iter(stream), []
+        for chunk in it:
+            head.append(chunk)
+            if chunk.choices and chunk.choices[0].delta.content:
+                with _upstream_lock:
+                    _ttft_samples.append(time.perf_counter() - started)
+                break
+        return stream, itertools.chain(head, it)
+    except BaseException:
+        stream.close()
+        raise
+
+def _close_loser(fut):
+    if not fut.cancelled() and fut.exception() is None:
+        fut.result()[0].close()
+
+def _hedged_open(ai, kwargs: dict):
+    """_first_token, with a second request raced against it once the first is
+    slower than the hedge threshold. The loser is closed when it answers.
+    """
+    after = _hedge_after()
+    if after is None:
+        return _first_token(ai, kwargs)
+    futures = [_hedge_pool.submit(_first_token, ai, kwargs)]
+    if not wait(futures, timeout=after).done:
+        futures.append(_hedge_pool.submit(_first_token, ai, kwargs))
+        with _upstream_lock:
+            _upstream_stats["hedges"] += 1
+        _inc("forma_upstream_hedges_total", result="sent")
+    error = None
+    for fut in as_completed(futures):
+        try:
+            result = fut.result()
+        except Exception as exc:
+            error = error or exc
+            continue
+        for other in futures:
+            if other is not fut:
+                other.add_done_callback(_close_loser)
+        if fut is not futures[0]:
+            with _upstream_lock:
+                _upstream_stats["hedge_wins"] += 1
+            _inc("forma_upstream_hedges_total", result="won")
+        return result
+    raise error
+
+def _open_stream(ai, mode: str, msgs: list, stop=None):
+    """Open an /analyze stream with retries and hedging. Returns (stream, chunks)."""
+    kwargs = dict(model="gpt-4o", messages=msgs, max_tokens=_MAX_TOKENS[mode],
+                  stream=True, timeout=_upstream_timeout(mode, True))
+    return _with_retries("analyze", lambda: _hedged_open(ai, kwargs), stop, _breaker_for(ai))
+
+def _upstream_status() -> dict:
+    with _upstream_lock:
+        counters = dict(_upstream_stats)
+        key_breakers = list(_key_breakers.values())
+    return {**counters, "breaker": _breaker.stats(),
+            "key_breakers": {"tracked": len(key_breakers),
+                             "open": sum(b.is_open() for b in key_breakers)},
+            "budgets": _BUDGETS,
+            "max_retries": UPSTREAM_RETRIES, "hedge_after": _hedge_after()}
+
+# ── Response cache ─────────────────────────────────────────────────────────────
+
+# Answers keyed by SHA-256 of image bytes + normalized question/mode/history.
+# Hot entries live in an in-process LRU; every entry is also written to SQLite
+# so hits survive restarts. Send "X-Forma-Cache: bypass" to force a fresh call.
+
+_cache: OrderedDict = OrderedDict()  # key -> (answer, created_at)
+_cache_lock  = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "bypassed": 0}
+
+def _cache_key(image_hash: str, question: str, mode: str, history=None) -> str:
+    """image_hash is the hex SHA-256 of the raw upload, shared with the image store."""
+    norm_q = " ".join(question.split()).casefold()
+    return hashlib.sha256(json.dumps([image_hash, norm_q, mode, history or []],
+                                     sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def _cache_bypassed(req) -> bool:
+    if req.headers.get("X-Forma-Cache", "").lower() == "bypass":
+        with _cache_lock:
+            _cache_stats["bypassed"] += 1
+        return True
+    return False
+
+def _cache_get(key: str):
+    """Return the cached answer for key, or None. Counts hits and misses."""
+    now = int(time.time())
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry and now - entry[1] < CACHE_TTL:
+            _cache.move_to_end(key)
+            _cache_stats["hits"] += 1
+            return entry[0]
+        _cache.pop(key, None)
+    with _get_db() as db:
+        row = db.execute("SELECT answer, created_at FROM response_cache WHERE key=? AND created_at>?",
+                         (key, now - CACHE_TTL)).fetchone()
+    with _cache_lock:
+        if row:
+            _cache_stats["hits"] += 1
+            _cache_remember(key, row["answer"], row["created_at"])
+            return row["answer"]
+        _cache_stats["misses"] += 1
+    return None
+
+def _cache_remember(key: str, answer: str, created_at: int):
+    # Caller holds _cache_lock
+    if CACHE_SIZE <= 0:
+        return
+    _cache[key] = (answer, created_at)
+    _cache.move_to_end(key)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+def _cache_put(key: str, answer: str):
+    now = int(time.time())
+    with _cache_lock:
+        _cache_remember(key, answer, now)
+    with _get_db() as db:
+        db.execute("INSERT OR REPLACE INTO response_cache VALUES (?,?,?)", (key, answer, now))
+        db.execute("DELETE FROM response_cache WHERE created_at<=?", (now - CACHE_TTL,))
+
+def _replay_tokens(answer: str) -> list:
+    """Split a finished answer into word tokens, as if it had been streamed."""
+    return re.findall(r"\s*\S+|\s+$", answer)
+
+def _cache_replay(answer: str):
+    """Yield a cached answer in the same SSE token format as a live stream."""
+    for tok in _replay_tokens(answer):
+        yield f"data: {json.dumps({'token': tok})}\n\n"
+    yield "data: [DONE]\n\n"
+
+# ── In-flight coalescing ───────────────────────────────────────────────────────
+
+# Identical requests that miss the cache while an answer for the same key is
+# still being generated subscribe to that generation instead of calling
+# upstream again. Every subscriber reads the tokens from the start, so late
+# joiners catch up. The upstream call is owned by the flight rather than by
+# the request that started it, and is cancelled only once every subscriber
+# has gone. Bypass requests get a private flight and never coalesce.
+
+_flights: dict = {}  # cache key -> _Flight
+_flights_lock = threading.Lock()
+_flight_stats = {"started": 0, "joined": 0, "abandoned": 0}
+
+class _Flight:
+    def __init__(self, key):
+        self.key       = key
+        self.parts     = []     # tokens so far
+        self.answer    = None   # set with done, unless error
+        self.error     = None   # user-facing message
+        self.done      = False
+        self.watchers  = 1
+        self.abandoned = False
+        self.abort     = None   # optional callable that cancels the upstream call
+        self.cond      = threading.Condition()
+        self._listeners = []    # callables run on every publish (asgi.py wakes coroutines with these)
+
+    def publish(self, token: str):
+        with self.cond:
+            self.parts.append(token)
+            self.cond.notify_all()
+        self._notify()
+
+    def finish(self, answer=None, error=None):
+        with self.cond:
+            self.done, self.answer, self.error = True, answer, error
+            self.cond.notify_all()
+        with _flights_lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+        self._notify()
+
+    def leave(self):
+        """Drop one subscriber. The last one to leave an unfinished flight aborts it."""
+        with _flights_lock:
+            self.watchers -= 1
+            if self.watchers or self.done:
+                return
+            self.abandoned = True
+            _flight_stats["abandoned"] += 1
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+        if self.abort:
+            self.abort()
+
+    def tail(self, i: int):
+        """Tokens after the first i, and whether the flight is done.
+
+        An answer finished without streamed tokens (a /batch call) is replayed
+        as words, so a streaming subscriber still gets token events.
+        """
+        with self.cond:
+            if self.done and not self.parts and self.answer and i == 0:
+                return _replay_tokens(self.answer), True
+            return self.parts[i:], self.done
+
+    def follow(self):
+        """Yield tokens as they are published until the flight is done."""
+        i = 0
+        while True:
+            with self.cond:
+                while not self.done and len(self.parts) <= i:
+                    self.cond.wait()
+                tokens, done = self.tail(i)
+            i += len(tokens)
+            yield from tokens
+            if done:
+                return
+
+    def listen(self, callback):
+        with self.cond:
+            self._listeners.append(callback)
+
+    def unlisten(self, callback):
+        with self.cond:
+            self._listeners.remove(callback)
+
+    def _notify(self):
+        with self.cond:
+            listeners = list(self._listeners)
+        for callback in listeners:
+            callback()
+
+def _flight_join(key: str, call: str, bypass: bool = False):
+    """Return (flight, leader). The leader produces the answer and finishes the
+    flight; every caller, leader included, calls leave() when done with it.
+    """
+    with _flights_lock:
+        flight = None if bypass else _flights.get(key)
+        if flight is not None:
+            flight.watchers += 1
+            _flight_stats["joined"] += 1
+        else:
+            flight = _Flight(key)
+            if not bypass:
+                _flights[key] = flight
+            _flight_stats["started"] += 1
+        leader = flight.watchers == 1
+    if not leader:
+        _inc("forma_coalesced_total", call=call)
+    return flight, leader
+
 # ── File validation ────────────────────────────────────────────────────────────
 
 def _ext_ok(name: str) -> bool:
     return "." in name and name.rsplit(".", 1)[1].lower() in ALLOWED_EXT
 
 def _magic_ok(data: bytes) -> bool:
-    return (
-        data[:3] == b"\xff\xd8\xff"
-        or data[:8] == b"\x89PNG\r\n\x1a\n"
-        or data[:6] in (b"GIF87a", b"GIF89a")
-        or (data[:4] == b"RIFF" and len(data) >= 12 and data[8:12] == b"WEBP")
-    )
+    return _sniff_mime(data) is not None
+
+# ── Image preprocessing ────────────────────────────────────────────────────────
+
+_image_stats = {"images": 0, "original_bytes": 0, "sent_bytes": 0}
+_image_lock  = threading.Lock()
+
+def _prepare_image(raw: bytes, mime: str, mode: str):
+    """Downscale, strip metadata and re-encode an upload for the model.
+
+    Returns (data, mime, detail). Falls back to the original bytes if Pillow is
+    not installed or the image can't be decoded.
+    """
+    detail = _IMAGE_DETAIL.get(mode, "high")
+    data, out_mime = raw, mime
+    try:
+        from PIL import Image, ImageOps
+
+        with Image.open(io.BytesIO(raw)) as img:
+            w, h = img.size
+            orient  = img.getexif().get(0x0112, 1)
+            rotated = orient in (5, 6, 7, 8)
+            if rotated:  # size the image as it will be displayed
+                w, h = h, w
+            long_side, short_side = _IMAGE_MAX_SIDE[detail]
+            scale = min(1.0, long_side / max(w, h), short_side / min(w, h))
+            size  = (max(1, round(w * scale)), max(1, round(h * scale)))
+            img.draft("RGB", size[::-1] if rotated else size)  # lets JPEG decode straight at reduced scale
+            alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+            frame = img.convert("RGBA" if alpha else "RGB")
+            if orient != 1:  # the tag is dropped on re-encode, so apply it to the pixels
+                frame = ImageOps.exif_transpose(frame)
+            if frame.size != size:  # shrink before flattening to keep full-size buffers few
+                frame = frame.resize(size, Image.LANCZOS, reducing_gap=3.0)
+            flat = frame
+            if alpha:
+                flat = Image.new("RGB", frame.size, "white")
+                flat.paste(frame, mask=frame.getchannel("A"))
+            out = io.BytesIO()
+            flat.save(out, "JPEG", quality=IMAGE_QUALITY, optimize=True)
+        if scale < 1 or out.tell() < len(raw):
+            data, out_mime = out.getvalue(), "image/jpeg"
+    except Exception:
+        pass  # ImportError or undecodable image: send as uploaded
+
+    with _image_lock:
+        _image_stats["images"]         += 1
+        _image_stats["original_bytes"] += len(raw)
+        _image_stats["sent_bytes"]     += len(data)
+    return data, out_mime, detail
 
 # ── PDF generation ─────────────────────────────────────────────────────────────
 
-def _make_pdf(rows):
-    """Generate a PDF from a list of analysis rows. Returns bytes."""
+# Exports page through analyses with keyset queries, embed downsampled
+# images and lay out one page at a time from a short queue of flowables, so
+# memory stays flat however large the project is. Finished PDFs are cached on
+# disk, keyed by projects.version, which triggers bump whenever the project's
+# analyses change.
+
+PDF_IMAGE_PX    = 900  # longest side of embedded images (3 in at 300 dpi)
+PDF_PAGE        = 50   # analyses read per query while rendering
+PDF_CACHE_FILES = int(os.environ.get("FORMA_PDF_CACHE_FILES", 64))
+PDF_CACHE_DIR   = os.environ.get("FORMA_PDF_CACHE") or os.path.join(tempfile.gettempdir(), "forma-pdf")
+
+_PDF_SELECT = ("SELECT a.rowid AS rid, a.id, a.question, a.answer, a.mode, a.created_at, a.image_hash "
+               "FROM analyses a")
+
+def _pdf_rows(where: str, params: tuple):
+    """Yield analysis dicts for a PDF in created_at order, each with a downsampled 'image'.
+
+    Images are read one at a time, and only the last one is kept, which covers
+    the usual run of questions about the same image. No connection is held
+    between pages.
+    """
+    after, last = (-2**63, -1), (None, None)  # before any int64 created_at
+    while True:
+        with _get_db() as db:
+            rows = db.execute(_PDF_SELECT + f" WHERE {where} AND (a.created_at, a.rowid) > (?, ?) "
+                              "ORDER BY a.created_at, a.rowid LIMIT ?", (*params, *after, PDF_PAGE)).fetchall()
+        for r in rows:
+            digest = r["image_hash"]
+            if digest and digest != last[0]:
+                with _get_db() as db:
+                    img = db.execute("SELECT data FROM images WHERE hash=?", (digest,)).fetchone()
+                last = (digest, img and (_make_thumb(img["data"], PDF_IMAGE_PX, IMAGE_QUALITY) or img["data"]))
+            yield {**dict(r), "image": last[1] if digest else None}
+        if len(rows) < PDF_PAGE:
+            return
+        after = (rows[-1]["created_at"], rows[-1]["rid"])
+
+def _make_pdf(rows, path: str, generated=None) -> bool:
+    """Render analysis rows (any iterable) to a PDF at path. False if reportlab is missing.
+
+    generated is the struct_time printed in the header (default: now). Pages
+    are laid out one at a time from a queue of at most PDF_PAGE flowables,
+    topped up from rows as it drains, instead of building the whole story
+    before rendering.
+    """
+    start = time.perf_counter()
     try:
         from reportlab.lib.pagesizes import letter
         from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
         from reportlab.lib.units import inch
         from reportlab.lib import colors
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, HRFlowable, Image as RLImage
-        from reportlab.lib.enums import TA_LEFT
-        import io, base64 as b64
-
-        buf = io.BytesIO()
-        doc = SimpleDocTemplate(buf, pagesize=letter,
-                                leftMargin=inch, rightMargin=inch,
-                                topMargin=inch, bottomMargin=inch)
-        styles = getSampleStyleSheet()
-        title_style = ParagraphStyle('title', parent=styles['Title'],
-                                     fontSize=20, textColor=colors.black, spaceAfter=6)
-        q_style     = ParagraphStyle('q', parent=styles['Normal'],
-                                     fontSize=11, textColor=colors.HexColor('#333333'),
-                                     fontName='Helvetica-Bold', spaceAfter=4)
-        a_style     = ParagraphStyle('a', parent=styles['Normal'],
-                                     fontSize=10, textColor=colors.HexColor('#111111'),
-                                     leading=16, spaceAfter=12)
-        meta_style  = ParagraphStyle('meta', parent=styles['Normal'],
-                                     fontSize=9, textColor=colors.HexColor('#888888'), spaceAfter=16)
-
-        story = [Paragraph("Forma Analysis Report", title_style),
-                 Paragraph(f"Generated {time.strftime('%B %d, %Y')}", meta_style),
-                 HRFlowable(width="100%", thickness=1, color=colors.HexColor('#cccccc')),
-                 Spacer(1, 0.2*inch)]
+        from reportlab.pdfgen.canvas import Canvas
+        from reportlab.platypus import Frame, KeepInFrame, Paragraph, Spacer, HRFlowable, Image as RLImage
+    except ImportError:
+        return False
+
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle('title', parent=styles['Title'],
+                                 fontSize=20, textColor=colors.black, spaceAfter=6)
+    q_style     = ParagraphStyle('q', parent=styles['Normal'],
+                                 fontSize=11, textColor=colors.HexColor('#333333'),
+                                 fontName='Helvetica-Bold', spaceAfter=4)
+    a_style     = ParagraphStyle('a', parent=styles['Normal'],
+                                 fontSize=10, textColor=colors.HexColor('#111111'),
+                                 leading=16, spaceAfter=12)
+    meta_style  = ParagraphStyle('meta', parent=styles['Normal'],
+                                 fontSize=9, textColor=colors.HexColor('#888888'), spaceAfter=16)
+
+    def story():
+        yield Paragraph("Forma Analysis Report", title_style)
+        yield Paragraph(f"Generated {time.strftime('%B %d, %Y', generated or time.localtime())}", meta_style)
+        yield HRFlowable(width="100%", thickness=1, color=colors.HexColor('#cccccc'))
+        yield Spacer(1, 0.2*inch)
 
         for row in rows:
-            qtext = row['question'] if isinstance(row, dict) else row[1]
-            atext = row['answer']   if isinstance(row, dict) else row[2]
-            mode  = row['mode']     if isinstance(row, dict) else row[3]
-            img64 = row.get('image_b64') if isinstance(row, dict) else (row[4] if len(row) > 4 else None)
-            ts    = row['created_at'] if isinstance(row, dict) else row[5]
+            yield Paragraph(_esc(row['question']), q_style)
+            yield Paragraph(f"Mode: {row['mode']} · "
+                            f"{time.strftime('%b %d %Y', time.localtime(row['created_at']))}", meta_style)
 
-            story.append(Paragraph(_esc(qtext), q_style))
-            story.append(Paragraph(f"Mode: {mode} · {time.strftime('%b %d %Y', time.localtime(ts))}", meta_style))
-
-            if img64:
+            if row['image']:
                 try:
-                    img_data = b64.b64decode(img64)
-                    img_io   = io.BytesIO(img_data)
-                    rl_img   = RLImage(img_io, width=3*inch, height=2*inch)
-                    story.append(rl_img)
-                    story.append(Spacer(1, 0.1*inch))
+                    image = RLImage(io.BytesIO(row['image']), width=3*inch, height=2*inch,
+                                    kind='proportional')
                 except Exception:
-                    pass
+                    image = None
+                if image:
+                    yield image
+                    yield Spacer(1, 0.1*inch)
 
             # Format answer paragraphs
-            for line in atext.split('\n'):
+            for line in row['answer'].split('\n'):
                 if line.strip():
-                    story.append(Paragraph(_esc(line), a_style))
-
-            story.append(HRFlowable(width="100%", thickness=0.5, color=colors.HexColor('#eeeeee')))
-            story.append(Spacer(1, 0.2*inch))
-
-        doc.build(story)
-        buf.seek(0)
-        return buf.read()
-    except ImportError:
-        return None
-
-# ── Share page template ────────────────────────────────────────────────────────
+                    yield Paragraph(_esc(line), a_style)
+
+            yield HRFlowable(width="100%", thickness=0.5, color=colors.HexColor('#eeeeee'))
+            yield Spacer(1, 0.2*inch)
+
+    width, height = letter
+    canvas  = Canvas(path, pagesize=letter)
+    flow    = story()
+    pending = []
+    frame   = Frame(inch, inch, width - 2*inch, height - 2*inch)
+    empty   = True  # nothing drawn in frame yet
+    while True:
+        pending.extend(itertools.islice(flow, max(0, PDF_PAGE - len(pending))))
+        if not pending:
+            break
+        queued = len(pending)
+        frame.addFromList(pending, canvas)
+        empty = empty and len(pending) == queued
+        if not pending:
+            continue  # the page has room left; top the queue up
+        parts = frame.split(pending[0], canvas)
+        if len(parts) > 1:  # a long paragraph continues on the next page
+            pending[:1] = parts
+            continue
+        if empty:
+            # Too tall for an empty page and can't be split: shrink it to fit
+            # (KeepInFrame's shrink mode always fits, so this happens once)
+            if isinstance(pending[0], KeepInFrame):
+                pending.pop(0)
+            else:
+                pending[0] = KeepInFrame(0, 0, [pending[0]], mode="shrink")
+            continue
+        canvas.showPage()
+        frame = Frame(inch, inch, width - 2*inch, height - 2*inch)
+        empty = True
+    canvas.save()
+    _observe("forma_pdf_render_seconds", time.perf_counter() - start)
+    return True
+
+def _pdf_cached(prefix: str, version, rows) -> str:
+    """Path of the cached PDF for prefix at version, rendering rows into it on a
+    miss. None without reportlab.
+
+    The file is named <prefix>-<version>-<yyyymmdd>.pdf, since the PDF prints
+    the day it was generated. It is rendered to a temp file and renamed into
+    place, so a reader never sees a partial PDF. Other files for the same
+    prefix are stale and are removed, as is anything past PDF_CACHE_FILES.
+    """
+    today = time.localtime()
+    name  = f"{prefix}-{version}-{time.strftime('%Y%m%d', today)}.pdf"
+    path  = os.path.join(PDF_CACHE_DIR, name)
+    if os.path.exists(path):
+        _inc("forma_pdf_cache_total", result="hit")
+        return path
+    _inc("forma_pdf_cache_total", result="miss")
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=PDF_CACHE_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        if not _make_pdf(rows, tmp, today):
+            return None
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    # Matched exactly: ids may contain "-", so project "abc" must not match "abc-1"
+    stale  = re.compile(re.escape(prefix) + r"-[0-9a-f]+-\d{8}\.pdf")
+    cached = sorted((e for e in os.scandir(PDF_CACHE_DIR) if e.name.endswith(".pdf")),
+                    key=lambda e: e.stat().st_mtime, reverse=True)
+    for i, entry in enumerate(cached):
+        if entry.name != name and (stale.fullmatch(entry.name) or i >= PDF_CACHE_FILES):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+    return path
+
+# ── Share pages ────────────────────────────────────────────────────────────────
 
 _SHARE_TPL = """<!DOCTYPE html><html lang="en"><head>
 <meta charset="UTF-8"><meta name="viewport" content="width=device-width,initial-scale=1">
@@ -209,23 +1363,250 @@ main{{max-width:720px;margin:0 auto;padding:5.5rem 1.5rem 4rem}}.badge{{display:
 <div class="foot">Generated by Forma — Spatial Reasoning Engine</div>
 </main></body></html>"""
 
+# Share pages are rendered once, at /save or on first view for analyses saved
+# by /batch and jobs, and stored in share_pages with the template fingerprint,
+# so editing _SHARE_TPL re-renders them lazily. Hot pages also sit in an LRU.
+
+SHARE_MAX_AGE  = int(os.environ.get("FORMA_SHARE_MAX_AGE", 3600))  # Cache-Control max-age, seconds
+SHARE_LRU_SIZE = 256
+_SHARE_VERSION = hashlib.sha256(_SHARE_TPL.encode()).hexdigest()[:12]
+_SHARE_INSERT  = "INSERT OR REPLACE INTO share_pages (id, html, etag, version, created_at) VALUES (?,?,?,?,?)"
+
+_share_lru: OrderedDict = OrderedDict()  # sid -> (html bytes, etag, created_at)
+_share_lock = threading.Lock()
+
+def _share_record(sid: str, row) -> tuple:
+    """Render one analysis into a share_pages row.
+
+    The row's created_at is the render time (never before the analysis), so
+    Last-Modified moves forward whenever the page is rendered again.
+    """
+    answer_html = re.sub(r"^(Step\s+\d+[:.)]?|\d+[.)]\s*)",
+                         r'<span class="sn">\1</span>', _esc(row["answer"]), flags=re.MULTILINE)
+    html = _SHARE_TPL.format(
+        q_short=_esc(row["question"][:60]), question=_esc(row["question"]),
+        answer=answer_html, mode=_esc(row["mode"]),
+        created=time.strftime("%B %d, %Y", time.localtime(row["created_at"])), sid=sid).encode()
+    return (sid, html, hashlib.sha256(html).hexdigest()[:20], _SHARE_VERSION,
+            max(int(time.time()), row["created_at"]))
+
+def _share_page(sid: str):
+    """(html, etag, rendered_at) for /r/<sid>, or None if there is no such analysis."""
+    with _share_lock:
+        if sid in _share_lru:
+            _share_lru.move_to_end(sid)
+            return _share_lru[sid]
+    with _get_db() as db:
+        row = db.execute("SELECT html, etag, created_at FROM share_pages WHERE id=? AND version=?",
+                         (sid, _SHARE_VERSION)).fetchone()
+        analysis = None if row else db.execute(
+            "SELECT question, answer, mode, created_at FROM analyses WHERE id=?", (sid,)).fetchone()
+    if row:
+        page = (row["html"], row["etag"], row["created_at"])
+    elif analysis:
+        rec = _share_record(sid, analysis)
+        with _get_db() as db:
+            db.execute(_SHARE_INSERT, rec)
+        page = (rec[1], rec[2], rec[4])
+    else:
+        return None
+    with _share_lock:
+        _share_lru[sid] = page
+        while len(_share_lru) > SHARE_LRU_SIZE:
+            _share_lru.popitem(last=False)
+    return page
+
 # ── Helpers ────────────────────────────────────────────────────────────────────
 
-def _validate_image(f):
-    """Returns (raw_bytes, mime_type, error_response)"""
+# Werkzeug spools file parts over 500 KB to temp files, so an upload only
+# costs memory once its bytes are read. Helpers below size, sniff and hash
+# the spooled stream and leave reading the whole file to the last moment.
+
+_UPLOAD_CHUNK = 1024 * 1024
+_B64_CHUNK    = 3 * 64 * 1024  # multiple of 3 so chunks encode without padding
+
+def _check_upload(f):
+    """Validate an upload without reading it. Returns (size, mime_type, error_response)"""
     if not f or not f.filename:
         return None, None, (jsonify({"error": "No image provided."}), 400)
     if not _ext_ok(f.filename):
         return None, None, (jsonify({"error": "Unsupported file type."}), 400)
-    raw = f.read()
-    if len(raw) > MAX_BYTES:
+    stream = f.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    if size > MAX_BYTES:
         return None, None, (jsonify({"error": "Image too large (max 20 MB)."}), 400)
-    if not _magic_ok(raw):
+    head = stream.read(16)
+    stream.seek(0)
+    if not _magic_ok(head):
         return None, None, (jsonify({"error": "Invalid image content."}), 400)
     ext  = f.filename.rsplit(".", 1)[1].lower()
     mime = {"jpg":"image/jpeg","jpeg":"image/jpeg","png":"image/png",
             "webp":"image/webp","gif":"image/gif"}.get(ext, "image/jpeg")
-    return raw, mime, None
+    return size, mime, None
+
+def _validate_image(f):
+    """Returns (raw_bytes, mime_type, error_response)"""
+    size, mime, err = _check_upload(f)
+    if err:
+        return None, None, err
+    return f.stream.read(size), mime, None
+
+def _hash_upload(f) -> str:
+    """Hex SHA-256 of a spooled upload, read in chunks."""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: f.stream.read(_UPLOAD_CHUNK), b""):
+        h.update(chunk)
+    f.stream.seek(0)
+    return h.hexdigest()
+
+def _data_url(data: bytes, mime: str) -> str:
+    """Base64 data URL for data.
+
+    Encodes chunk by chunk into one preallocated buffer, so the only full-size
+    copies are that buffer and the returned str (about 2.7x the input at peak).
+    """
+    prefix = f"data:{mime};base64,".encode()
+    buf  = bytearray(len(prefix) + 4 * ((len(data) + 2) // 3))
+    buf[:len(prefix)] = prefix
+    pos, view = len(prefix), memoryview(data)
+    for i in range(0, len(data), _B64_CHUNK):
+        enc = binascii.b2a_base64(view[i:i + _B64_CHUNK], newline=False)
+        buf[pos:pos + len(enc)] = enc
+        pos += len(enc)
+    return buf.decode("ascii")
+
+@app.errorhandler(413)
+def too_large(_exc):
+    limit = request.max_content_length or MAX_REQUEST_BYTES  # /import raises its own limit
+    return jsonify({"error": f"Request too large (max {limit // (1024 * 1024)} MB)."}), 413
+
+@app.before_request
+def _timer_start():
+    g.started = time.perf_counter()
+
+@app.after_request
+def _timer_stop(resp):
+    """Request metrics. For streamed responses this is the time to headers, not to the last byte."""
+    if METRICS and "started" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        _observe("forma_http_request_duration_seconds", time.perf_counter() - g.started, route=route)
+        _inc("forma_http_requests_total", route=route, method=request.method, status=resp.status_code)
+    return resp
+
+# ── Static assets ──────────────────────────────────────────────────────────────
+
+# /app serves renderer/index.html with its stylesheets and scripts replaced by
+# one CSS and one JS bundle named by content hash. Bundles are precompressed
+# with gzip, and brotli when installed, and cached by browsers for a year.
+# Everything is rebuilt when a renderer file changes. The Electron shell loads
+# renderer/index.html from disk and is unaffected.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_RENDERER    = os.path.join(os.path.dirname(os.path.abspath(__file__)), "renderer")
+_ASSET_TAG   = re.compile(r'[ \t]*(?:<link rel="stylesheet" href="(styles/[^"]+)"\s*/?>'
+                          r'|<script src="(js/[^"]+)"></script>)\n?')
+_ASSET_CACHE = "public, max-age=31536000, immutable"
+
+_assets: dict = {}   # bundle name -> {"identity"/"gzip"/"br": bytes, "etag", "type"}
+_asset_page   = None  # (source mtimes, page entry) for /app
+_asset_lock   = threading.Lock()
+
+def _asset_entry(body: bytes, content_type: str) -> dict:
+    entry = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0),
+             "etag": hashlib.sha256(body).hexdigest()[:16], "type": content_type}
+    if brotli:
+        entry["br"] = brotli.compress(body, quality=11)
+    return entry
+
+def _build_assets():
+    """Bundle the assets index.html references.
+
+    Returns (page entry, {bundle name: entry}) for the rewritten page.
+    """
+    with open(os.path.join(_RENDERER, "index.html"), encoding="utf-8") as fh:
+        page = fh.read()
+    refs, bundles = {"css": [], "js": []}, {}
+    for css, js in _ASSET_TAG.findall(page):
+        refs["css" if css else "js"].append(css or js)
+    tags = {}
+    for kind, files in refs.items():
+        parts = []
+        for name in files:
+            with open(os.path.join(_RENDERER, name), "rb") as fh:
+                parts.append(fh.read())
+        body = (b";\n" if kind == "js" else b"\n").join(parts)  # scripts are IIFEs, order kept
+        entry = _asset_entry(body, "text/css; charset=utf-8" if kind == "css"
+                             else "application/javascript; charset=utf-8")
+        name = f"app.{entry['etag'][:10]}.{kind}"
+        bundles[name] = entry
+        tags[kind] = (f'  <link rel="stylesheet" href="/assets/{name}" />\n' if kind == "css"
+                      else f'<script src="/assets/{name}"></script>\n')
+    # The first tag of each kind becomes the bundle tag, the rest are dropped
+    page = _ASSET_TAG.sub(lambda m: tags.pop("css" if m.group(1) else "js", ""), page)
+    return _asset_entry(page.encode(), "text/html; charset=utf-8"), bundles
+
+def _asset_index() -> dict:
+    """The /app page entry, rebuilding it and its bundles if a renderer file changed.
+
+    Bundles from the previous build are dropped.
+    """
+    global _asset_page, _assets
+    sources = [os.path.join(_RENDERER, "index.html"), *glob.glob(os.path.join(_RENDERER, "js", "*.js")),
+               *glob.glob(os.path.join(_RENDERER, "styles", "*.css"))]
+    stamp = tuple(os.stat(p).st_mtime_ns for p in sources)
+    with _asset_lock:
+        if not _asset_page or _asset_page[0] != stamp:
+            page, _assets = _build_assets()
+            _asset_page = (stamp, page)
+        return _asset_page[1]
+
+def _send_asset(entry: dict, cache_control: str):
+    """Send the best precompressed variant the client accepts, or 304."""
+    accept = request.accept_encodings
+    enc = "br" if "br" in entry and accept["br"] else "gzip" if accept["gzip"] else "identity"
+    etag = f"{entry['etag']}-{enc}"
+    headers = {"Cache-Control": cache_control, "ETag": f'"{etag}"', "Vary": "Accept-Encoding"}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    if enc != "identity":
+        headers["Content-Encoding"] = enc
+    return Response(entry[enc], content_type=entry["type"], headers=headers)
+
+# ── Response compression ───────────────────────────────────────────────────────
+
+# Dynamic responses over COMPRESS_MIN bytes are compressed with brotli or gzip,
+# whichever the client accepts. Streamed responses (SSE, send_file) are left
+# alone, as are responses with an ETag, whose conditional checks compare the
+# uncompressed representation.
+
+_COMPRESSIBLE = {"application/json", "text/html", "text/plain", "text/csv"}
+
+@app.after_request
+def _compress(resp):
+    if (resp.direct_passthrough or resp.is_streamed or resp.status_code != 200
+            or resp.mimetype not in _COMPRESSIBLE
+            or "Content-Encoding" in resp.headers or "ETag" in resp.headers):
+        return resp
+    body = resp.get_data()
+    if len(body) < COMPRESS_MIN:
+        return resp
+    accept = request.accept_encodings
+    if brotli and accept["br"]:
+        enc, body = "br", brotli.compress(body, quality=5)  # fast levels; bundles use 11
+    elif accept["gzip"]:
+        enc, body = "gzip", gzip.compress(body, 6)
+    else:
+        return resp
+    resp.set_data(body)
+    resp.headers["Content-Encoding"] = enc
+    resp.vary.add("Accept-Encoding")
+    return resp
 
 # ── Routes: static ─────────────────────────────────────────────────────────────
 
@@ -235,7 +1616,15 @@ def index():
 
 @app.route("/app")
 def app_page():
-    return send_from_directory("renderer", "index.html")
+    return _send_asset(_asset_index(), "no-cache")  # revalidated each time; bundles carry the caching
+
+@app.route("/assets/<name>")
+def asset(name):
+    _asset_index()  # a fresh worker may not have built the bundles yet
+    entry = _assets.get(name)
+    if not entry:
+        return "Not found.", 404
+    return _send_asset(entry, _ASSET_CACHE)
 
 # Serve renderer static files (CSS, JS) at their relative paths
 @app.route("/styles/<path:filename>")
@@ -257,14 +1646,34 @@ def auth():
     key = (request.json or {}).get("key", "")
     return jsonify({"ok": key == _pw})
 
+@app.route("/metrics")
+def metrics():
+    if not METRICS:
+        return jsonify({"error": "Metrics are disabled."}), 404
+    with _job_depth_lock:
+        depth = {(("state", k),): v for k, v in _job_depth.items()}
+    with _metrics_lock:
+        _metrics["forma_batch_queue_depth"][3] = depth
+        _metrics["forma_upstream_breaker_open"][3] = {(): int(_breaker.is_open())}
+    return Response(_render_metrics(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/stats")
 def stats():
     uses = _uses_this_minute()
     db_size = os.path.getsize(DB_PATH) // 1024 if os.path.exists(DB_PATH) else 0
     with _get_db() as db:
         total = db.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+    with _cache_lock:
+        cache = {**_cache_stats, "entries": len(_cache), "max_entries": CACHE_SIZE}
+    with _image_lock:
+        images = dict(_image_stats)
+    with _flights_lock:
+        inflight = {**_flight_stats, "active": len(_flights)}
     return jsonify({"total_analyses": total, "db_size_kb": db_size,
-                    "uses_this_minute": uses, "rate_limit": RATE_LIMIT})
+                    "uses_this_minute": uses, "rate_limit": RATE_LIMIT,
+                    "batch_rate_limit": BATCH_RATE_LIMIT, "cache": cache,
+                    "images": images, "openai_clients": _clients.stats(), "inflight": inflight,
+                    "upstream": _upstream_status()})
 
 @app.route("/config", methods=["POST"])
 def set_config():
@@ -301,13 +1710,12 @@ def set_config():
 
 @app.route("/projects", methods=["GET"])
 def list_projects():
+    # Counts and latest activity are maintained by triggers (see _m_project_counters)
     with _get_db() as db:
-        rows = db.execute("SELECT * FROM projects ORDER BY created_at DESC").fetchall()
-        result = []
-        for r in rows:
-            count = db.execute("SELECT COUNT(*) FROM analyses WHERE project_id=?", (r["id"],)).fetchone()[0]
-            result.append({**dict(r), "analysis_count": count})
-    return jsonify(result)
+        rows = db.execute("SELECT id,name,emoji,created_at,analysis_count,last_activity,last_image_hash "
+                          "FROM projects ORDER BY created_at DESC").fetchall()
+    return jsonify([{**dict(r), "thumb_url": f"/images/{r['last_image_hash']}/thumb"
+                     if r["last_image_hash"] else None} for r in rows])
 
 @app.route("/projects", methods=["POST"])
 def create_project():
@@ -318,7 +1726,9 @@ def create_project():
         return jsonify({"error": "Project name required."}), 400
     pid = secrets.token_hex(4)
     with _get_db() as db:
-        db.execute("INSERT INTO projects VALUES (?,?,?,?)", (pid, name, emoji, int(time.time())))
+        now = int(time.time())
+        db.execute("INSERT INTO projects (id,name,emoji,created_at,last_activity) VALUES (?,?,?,?,?)",
+                   (pid, name, emoji, now, now))
     return jsonify({"id": pid, "name": name, "emoji": emoji})
 
 @app.route("/projects/<pid>", methods=["DELETE"])
@@ -343,11 +1753,38 @@ def update_project(pid):
 
 @app.route("/projects/<pid>/analyses", methods=["GET"])
 def project_analyses(pid):
+    """A project's analyses, newest first, a page at a time (see /search for
+    cursor and fields= handling).
+    """
+    limit = max(1, min(request.args.get("limit", 50, type=int), 200))
+    try:
+        after = _decode_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except ValueError:
+        return jsonify({"error": "Invalid cursor."}), 400
+    sql    = f"SELECT rowid AS rid, {_list_columns('')} FROM analyses WHERE project_id=?"
+    params = [pid]
+    if after:
+        sql += " AND (created_at, rowid) < (?, ?)"
+        params += after
+    sql += " ORDER BY created_at DESC, rowid DESC LIMIT ?"
+    params.append(limit)
+    with _get_db() as db:
+        rows = [dict(r) for r in db.execute(sql, params).fetchall()]
+    headers = {}
+    if len(rows) == limit:
+        headers["X-Next-Cursor"] = _encode_cursor(rows[-1]["created_at"], rows[-1]["rid"])
+    for r in rows:
+        del r["rid"]
+    return jsonify(rows), 200, headers
+
+@app.route("/analyses/<aid>")
+def get_analysis(aid):
     with _get_db() as db:
-        rows = db.execute(
-            "SELECT id,question,answer,mode,created_at FROM analyses WHERE project_id=? ORDER BY created_at DESC",
-            (pid,)).fetchall()
-    return jsonify([dict(r) for r in rows])
+        row = db.execute("SELECT id,question,answer,mode,image_hash,project_id,created_at "
+                         "FROM analyses WHERE id=?", (aid,)).fetchone()
+    if not row:
+        return jsonify({"error": "Not found."}), 404
+    return jsonify(dict(row))
 
 @app.route("/analyses/<aid>/move", methods=["PATCH"])
 def move_analysis(aid):
@@ -358,27 +1795,95 @@ def move_analysis(aid):
 
 # ── Routes: search ─────────────────────────────────────────────────────────────
 
+def _fts_query(q: str) -> str:
+    """Turn free text into an FTS5 query where every word must match as a prefix."""
+    return " ".join('"{}"*'.format(w.replace('"', '""')) for w in q.split())
+
+def _encode_cursor(*vals) -> str:
+    return base64.urlsafe_b64encode(json.dumps(vals).encode()).decode()
+
+def _cursor_value(v, types) -> bool:
+    """True if v is one of types (never a bool) and binds to SQLite as-is."""
+    if isinstance(v, bool) or not isinstance(v, types):
+        return False
+    if isinstance(v, float):
+        return v - v == 0  # finite
+    return not isinstance(v, int) or -2**63 <= v < 2**63
+
+def _decode_cursor(cursor: str):
+    """[sort key, row id] from a cursor. Raises ValueError if it isn't one we issued."""
+    vals = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if (not isinstance(vals, list) or len(vals) != 2 or not _cursor_value(vals[0], (int, float))
+            or not _cursor_value(vals[1], (int, str))):
+        raise ValueError("malformed cursor")
+    return vals
+
+def _list_columns(alias: str = "a.") -> str:
+    """Columns for list endpoints: an answer excerpt, or the full answer with ?fields=answer."""
+    cols = f"{alias}id, {alias}question, {alias}mode, {alias}image_hash, {alias}created_at, " \
+           f"substr({alias}answer, 1, {EXCERPT_CHARS}) AS excerpt"
+    if "answer" in request.args.get("fields", "").split(","):
+        cols += f", {alias}answer"
+    return cols
+
 @app.route("/search")
 def search():
+    """Search analyses. Results are ranked by bm25 when q is given, newest first
+    otherwise. The next page is fetched by passing the X-Next-Cursor response
+    header back as ?cursor=. Rows carry an answer excerpt; ?fields=answer adds
+    the full text.
+    """
     q      = request.args.get("q", "").strip()
     mode   = request.args.get("mode", "")
-    from_ts = int(request.args.get("from", 0))
-    to_ts   = int(request.args.get("to", int(time.time()) + 86400))
-    limit   = min(int(request.args.get("limit", 50)), 200)
+    from_ts = request.args.get("from", 0, type=int)
+    to_ts   = request.args.get("to", int(time.time()) + 86400, type=int)
+    limit   = max(1, min(request.args.get("limit", 50, type=int), 200))
+    try:
+        after = _decode_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+    except ValueError:
+        return jsonify({"error": "Invalid cursor."}), 400
 
-    sql    = "SELECT id,question,answer,mode,created_at FROM analyses WHERE created_at BETWEEN ? AND ?"
+    sql    = f"SELECT a.rowid AS rid, {_list_columns()}"
+    where  = ["a.created_at BETWEEN ? AND ?"]
     params = [from_ts, to_ts]
-    if q:
-        sql += " AND (question LIKE ? OR answer LIKE ?)"
-        like = f"%{q}%"; params += [like, like]
     if mode:
-        sql += " AND mode=?"; params.append(mode)
-    sql += " ORDER BY created_at DESC LIMIT ?"
+        where.append("a.mode=?"); params.append(mode)
+
+    ranked = bool(q) and _fts
+    if ranked:
+        # \x02/\x03 mark hits so the snippet can be HTML-escaped before adding <mark>
+        sql += (", bm25(analyses_fts) AS rank, snippet(analyses_fts, -1, ?, ?, '…', 16) AS snippet"
+                " FROM analyses_fts JOIN analyses a ON a.rowid = analyses_fts.rowid")
+        where.insert(0, "analyses_fts MATCH ?")
+        params = ["\x02", "\x03", _fts_query(q)] + params
+        if after:
+            where.append("(bm25(analyses_fts) > ? OR (bm25(analyses_fts) = ? AND a.rowid > ?))")
+            params += [after[0], after[0], after[1]]
+        order = "bm25(analyses_fts), a.rowid"
+    else:
+        sql += " FROM analyses a"
+        if q:
+            where.append("(a.question LIKE ? OR a.answer LIKE ?)")
+            like = f"%{q}%"; params += [like, like]
+        if after:
+            where.append("(a.created_at, a.rowid) < (?, ?)")
+            params += [after[0], after[1]]
+        order = "a.created_at DESC, a.rowid DESC"
+    sql += f" WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ?"
     params.append(limit)
 
     with _get_db() as db:
-        rows = db.execute(sql, params).fetchall()
-    return jsonify([dict(r) for r in rows])
+        rows = [dict(r) for r in db.execute(sql, params).fetchall()]
+
+    headers = {}
+    if len(rows) == limit:
+        last = rows[-1]
+        headers["X-Next-Cursor"] = _encode_cursor(last["rank"] if ranked else last["created_at"], last["rid"])
+    for r in rows:
+        del r["rid"]
+        if ranked:
+            r["snippet"] = _esc(r["snippet"]).replace("\x02", "<mark>").replace("\x03", "</mark>")
+    return jsonify(rows), 200, headers
 
 # ── Routes: save / share ───────────────────────────────────────────────────────
 
@@ -391,111 +1896,1065 @@ def save():
     answer     = data.get("answer",   "").strip()
     mode       = data.get("mode",     "deep")
     project_id = data.get("project_id")
-    image_b64  = data.get("image_b64")  # optional thumbnail
+    image_b64  = data.get("image_b64")  # optional, stored once per content hash
     if not question or not answer:
         return jsonify({"error": "Missing question or answer."}), 400
+    rec = None
+    if image_b64:
+        # Same cap as /analyze; the encoded length is checked before decoding
+        if not isinstance(image_b64, str) or len(image_b64) > (MAX_BYTES + 2) // 3 * 4:
+            return jsonify({"error": "Image too large (max 20 MB)."}), 413
+        try:
+            raw = base64.b64decode(image_b64)
+        except ValueError:
+            raw = b""
+        if len(raw) > MAX_BYTES:
+            return jsonify({"error": "Image too large (max 20 MB)."}), 413
+        rec = _image_record(raw)
     sid = secrets.token_hex(4)
+    now = int(time.time())
     with _get_db() as db:
-        db.execute("INSERT INTO analyses VALUES (?,?,?,?,?,?,?)",
-                   (sid, question, answer, mode, image_b64, project_id, int(time.time())))
+        _store_images(db, [rec])
+        db.execute(_ANALYSIS_INSERT, (sid, question, answer, mode, rec and rec[0], project_id, now))
+        db.execute(_SHARE_INSERT, _share_record(sid, {"question": question, "answer": answer,
+                                                      "mode": mode, "created_at": now}))
     base = request.host_url.rstrip("/")
     return jsonify({"id": sid, "url": f"{base}/r/{sid}"})
 
 @app.route("/r/<sid>")
 def shared(sid):
+    page = _share_page(sid)
+    if not page:
+        return "Analysis not found.", 404
+    html, etag, modified = page
+    headers = {"ETag": f'"{etag}"', "Last-Modified": http_date(modified),
+               "Cache-Control": f"public, max-age={SHARE_MAX_AGE}"}
+    since = request.if_modified_since
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and since and since.timestamp() >= modified):
+        return Response(status=304, headers=headers)
+    return Response(html, mimetype="text/html", headers=headers)
+
+# ── Routes: images ─────────────────────────────────────────────────────────────
+
+@app.route("/images/<digest>")
+@app.route("/images/<digest>/thumb")
+def image_blob(digest):
+    thumb = request.path.endswith("/thumb")
+    if request.if_none_match.contains(digest):
+        return Response(status=304, headers={"ETag": f'"{digest}"'})
     with _get_db() as db:
-        row = db.execute("SELECT question,answer,mode,created_at FROM analyses WHERE id=?", (sid,)).fetchone()
+        row = db.execute(f"SELECT mime, {'thumb' if thumb else 'data'} AS body FROM images WHERE hash=?",
+                         (digest,)).fetchone()
+        if row and thumb and row["body"] is None:  # no Pillow when stored: fall back to original
+            row = db.execute("SELECT mime, data AS body FROM images WHERE hash=?", (digest,)).fetchone()
+            thumb = False
     if not row:
-        return "Analysis not found.", 404
-    answer_html = re.sub(r"^(Step\s+\d+[:.)]?|\d+[.)]\s*)",
-                         r'<span class="sn">\1</span>', _esc(row["answer"]), flags=re.MULTILINE)
-    return _SHARE_TPL.format(
-        q_short=_esc(row["question"][:60]), question=_esc(row["question"]),
-        answer=answer_html, mode=_esc(row["mode"]),
-        created=time.strftime("%B %d, %Y", time.localtime(row["created_at"])), sid=sid)
+        return "Image not found.", 404
+    return Response(row["body"], mimetype="image/jpeg" if thumb else row["mime"],
+                    headers={"Cache-Control": "public, max-age=31536000, immutable",
+                             "ETag": f'"{digest}"', "X-Content-Type-Options": "nosniff"})
 
 # ── Routes: export ─────────────────────────────────────────────────────────────
 
 @app.route("/export/<sid>/pdf")
 def export_analysis_pdf(sid):
     with _get_db() as db:
-        row = db.execute("SELECT * FROM analyses WHERE id=?", (sid,)).fetchone()
+        row = db.execute("SELECT question, answer, mode, image_hash, created_at FROM analyses WHERE id=?",
+                         (sid,)).fetchone()
     if not row:
         return "Not found.", 404
-    pdf = _make_pdf([dict(row)])
-    if not pdf:
+    # /import can replace an analysis in place, so the key covers what the PDF shows
+    version = hashlib.sha256("\0".join(str(v) for v in row).encode()).hexdigest()[:12]
+    path = _pdf_cached(f"analysis-{sid}", version, _pdf_rows("a.id=?", (sid,)))
+    if not path:
         return jsonify({"error": "reportlab not installed."}), 500
-    return Response(pdf, mimetype="application/pdf",
-                    headers={"Content-Disposition": f'attachment; filename="forma-{sid}.pdf"'})
+    return send_file(path, mimetype="application/pdf", as_attachment=True,
+                     download_name=f"forma-{sid}.pdf")
 
 @app.route("/projects/<pid>/export/pdf")
 def export_project_pdf(pid):
     with _get_db() as db:
-        proj = db.execute("SELECT name FROM projects WHERE id=?", (pid,)).fetchone()
-        rows = db.execute("SELECT * FROM analyses WHERE project_id=? ORDER BY created_at", (pid,)).fetchall()
+        proj = db.execute("SELECT name, version FROM projects WHERE id=?", (pid,)).fetchone()
     if not proj:
         return "Project not found.", 404
-    pdf = _make_pdf([dict(r) for r in rows])
-    if not pdf:
+    path = _pdf_cached(f"project-{pid}", proj["version"], _pdf_rows("a.project_id=?", (pid,)))
+    if not path:
         return jsonify({"error": "reportlab not installed."}), 500
     name = re.sub(r'[^\w\-]', '_', proj["name"])
-    return Response(pdf, mimetype="application/pdf",
-                    headers={"Content-Disposition": f'attachment; filename="forma-{name}.pdf"'})
+    return send_file(path, mimetype="application/pdf", as_attachment=True,
+                     download_name=f"forma-{name}.pdf")
+
+# ── Routes: NDJSON export / import ─────────────────────────────────────────────
+
+# One JSON object per line, each with a "type": a "meta" header, then
+# "project" rows, then "analysis" rows oldest first, each preceded by its
+# "image" when images are inline, then an "end" trailer with the row count.
+# Export reads a page at a time and holds no connection between pages;
+# import commits every IMPORT_BATCH rows. Neither holds the whole history in
+# memory, so both scale to millions of rows.
+
+NDJSON_FORMAT   = "forma-ndjson"
+NDJSON_VERSION  = 1
+NDJSON_PAGE     = 1000   # analyses read per query
+_IMPORT_ERRORS  = 100    # errors listed in the /import summary
+_IMPORT_BYTES   = 64 * 1024 * 1024  # inline image bytes buffered before a batch is flushed
+_HASH_RE        = re.compile(r"[0-9a-f]{64}")
+_ID_RE          = re.compile(r"[\w-]{1,64}", re.ASCII)  # ids end up in URLs and markup
+_ID_TRIES       = 8      # fresh ids drawn before giving up on a row
+_IMPORT_ANALYSIS = _ANALYSIS_INSERT.replace("INSERT", "INSERT OR IGNORE", 1)
+
+def _ndjson(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+def _import_time(value) -> int:
+    """A row's created_at as an int64, or now if it is missing. Raises ValueError if out of range."""
+    if value is None or value == "":
+        return int(time.time())
+    if isinstance(value, bool):
+        raise ValueError("created_at must be unix seconds")
+    try:
+        ts = int(value)
+    except OverflowError:  # Infinity
+        raise ValueError("created_at is out of range") from None
+    except (ValueError, TypeError):
+        raise ValueError("created_at must be unix seconds") from None
+    if not -2**63 <= ts < 2**63:
+        raise ValueError("created_at is out of range")
+    return ts
+
+def _ndjson_export(where: list, params: list, pid, inline: bool, filters: dict):
+    yield _ndjson({"type": "meta", "format": NDJSON_FORMAT, "version": NDJSON_VERSION,
+                   "exported_at": int(time.time()), "images": "inline" if inline else "ref",
+                   "filters": filters})
+    with _get_db() as db:
+        projects = db.execute("SELECT id,name,emoji,created_at FROM projects" + (" WHERE id=?" if pid else "")
+                              + " ORDER BY created_at", (pid,) if pid else ()).fetchall()
+    for p in projects:
+        yield _ndjson({"type": "project", **dict(p)})
+
+    sql = ("SELECT rowid AS rid, id, question, answer, mode, image_hash, project_id, created_at "
+           f"FROM analyses WHERE {' AND '.join(where)} AND (created_at, rowid) > (?, ?) "
+           "ORDER BY created_at, rowid LIMIT ?")
+    after, count = (-2**63, -1), 0  # before any int64 created_at
+    sent: OrderedDict = OrderedDict()  # recently sent image hashes; a repeat beyond this is harmless
+    while True:
+        with _get_db() as db:
+            rows = db.execute(sql, (*params, *after, NDJSON_PAGE)).fetchall()
+        for r in rows:
+            row = dict(r)
+            del row["rid"]
+            digest = row["image_hash"]
+            if digest and inline and digest not in sent:
+                with _get_db() as db:
+                    img = db.execute("SELECT mime, data FROM images WHERE hash=?", (digest,)).fetchone()
+                if img:
+                    yield _ndjson({"type": "image", "hash": digest, "mime": img["mime"],
+                                   "data": base64.b64encode(img["data"]).decode("ascii")})
+                sent[digest] = True
+                if len(sent) > 4096:
+                    sent.popitem(last=False)
+            elif digest and not inline:
+                row["image_url"] = f"/images/{digest}"
+            count += 1
+            yield _ndjson({"type": "analysis", **row})
+        if len(rows) < NDJSON_PAGE:
+            break
+        after = (rows[-1]["created_at"], rows[-1]["rid"])
+    yield _ndjson({"type": "end", "analyses": count})
+
+@app.route("/export/ndjson")
+def export_ndjson():
+    """Export analyses as NDJSON. Optional project_id, from/to (unix seconds),
+    and images=ref (URLs, default) or inline (base64 image rows).
+    """
+    if not _authed(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    pid    = request.args.get("project_id") or None
+    images = request.args.get("images", "ref")
+    if images not in ("ref", "inline"):
+        return jsonify({"error": "images must be ref or inline."}), 400
+    try:
+        from_ts = int(request.args.get("from", -2**63))  # imports may carry pre-1970 times
+        to_ts   = int(request.args.get("to", 2**63 - 1))
+    except ValueError:
+        return jsonify({"error": "from and to must be unix seconds."}), 400
+    from_ts, to_ts = max(from_ts, -2**63), min(to_ts, 2**63 - 1)
+    where, params = ["created_at BETWEEN ? AND ?"], [from_ts, to_ts]
+    if pid:
+        where.append("project_id=?"); params.append(pid)
+    filters = {k: v for k, v in (("project_id", pid), ("from", request.args.get("from")),
+                                 ("to", request.args.get("to"))) if v}
+    name = f"forma-{pid or 'all'}-{time.strftime('%Y%m%d')}.ndjson"
+    return Response(_ndjson_export(where, params, pid, images == "inline", filters),
+                    mimetype="application/x-ndjson",
+                    headers={"Content-Disposition": f'attachment; filename="{name}"'})
+
+class _ImportBatch:
+    """Rows from one /import, applied IMPORT_BATCH at a time in a single transaction each."""
+
+    def __init__(self, on_conflict: str):
+        self.on_conflict = on_conflict
+        self.pending     = []
+        self.bytes       = 0
+        self.project_ids = {}   # imported project id -> id stored (differs after a rename)
+        self.summary = {"lines": 0,
+                        "projects": {"inserted": 0, "skipped": 0, "replaced": 0, "renamed": 0},
+                        "analyses": {"inserted": 0, "skipped": 0, "replaced": 0, "renamed": 0},
+                        "images":   {"inserted": 0, "skipped": 0},
+                        "error_count": 0, "errors": []}
+        with _get_db() as db:
+            self.known = {r["id"] for r in db.execute("SELECT id FROM projects")}
+
+    def error(self, line: int, msg: str):
+        self.summary["error_count"] += 1
+        if len(self.summary["errors"]) < _IMPORT_ERRORS:
+            self.summary["errors"].append({"line": line, "error": msg})
+
+    def add(self, kind: str, rec: tuple, size: int = 0):
+        self.pending.append((kind, rec, self.summary["lines"]))
+        self.bytes += size
+        if len(self.pending) >= IMPORT_BATCH or self.bytes >= _IMPORT_BYTES:
+            self.flush()
+
+    def flush(self):
+        """Write pending rows in one transaction. A row the database rejects is
+        reported and the rest of the batch kept: SQLite undoes only the failing
+        statement, and each row's first write is the one that can fail.
+        """
+        if not self.pending:
+            return
+        with _get_db(immediate=True) as db:
+            for kind, rec, line in self.pending:
+                try:
+                    getattr(self, f"_put_{kind}")(db, rec)
+                except (sqlite3.Error, OverflowError) as exc:
+                    self.error(line, f"database error: {exc}")
+        self.pending, self.bytes = [], 0
+
+    @staticmethod
+    def _insert_fresh(db, sql: str, rest: tuple) -> str:
+        """Insert (new id, *rest) with sql (an INSERT OR IGNORE), drawing a new
+        random id on the rare collision. Returns the id used.
+        """
+        for _ in range(_ID_TRIES):
+            new = secrets.token_hex(4)
+            if db.execute(sql, (new, *rest)).rowcount:
+                return new
+        raise sqlite3.IntegrityError("no free id found")
+
+    def _count(self, table: str, outcome: str):
+        self.summary[table][outcome] += 1
+
+    def _put_image(self, db, rec):
+        added = db.execute("INSERT OR IGNORE INTO images VALUES (?,?,?,?,?)", rec).rowcount
+        self._count("images", "inserted" if added else "skipped")
+
+    def _put_project(self, db, rec):
+        pid, name, emoji, created_at = rec
+        if db.execute("INSERT OR IGNORE INTO projects (id,name,emoji,created_at,last_activity) "
+                      "VALUES (?,?,?,?,?)", (pid, name, emoji, created_at, created_at)).rowcount:
+            self._count("projects", "inserted")
+        elif self.on_conflict == "replace":
+            db.execute("UPDATE projects SET name=?, emoji=? WHERE id=?", (name, emoji, pid))
+            self._count("projects", "replaced")
+        elif self.on_conflict == "rename":
+            new = self._insert_fresh(db, "INSERT OR IGNORE INTO projects (id,name,emoji,created_at,last_activity) "
+                                         "VALUES (?,?,?,?,?)", (name, emoji, created_at, created_at))
+            self.project_ids[pid] = new
+            self._count("projects", "renamed")
+        else:
+            self._count("projects", "skipped")
+        self.known.add(self.project_ids.get(pid, pid))
+
+    def _put_analysis(self, db, rec):
+        pid = self.project_ids.get(rec[5], rec[5])  # resolved here, after earlier project rows
+        rec = (*rec[:5], pid if pid in self.known else None, rec[6])
+        aid, rest = rec[0], rec[1:]
+        if aid is None:  # the row had no id
+            self._insert_fresh(db, _IMPORT_ANALYSIS, rest)
+            self._count("analyses", "inserted")
+        elif db.execute(_IMPORT_ANALYSIS, rec).rowcount:
+            self._count("analyses", "inserted")
+        elif self.on_conflict == "replace":
+            # UPDATE rather than INSERT OR REPLACE, so the FTS and project counter triggers run
+            db.execute("UPDATE analyses SET question=?, answer=?, mode=?, image_hash=?, project_id=?, "
+                       "created_at=? WHERE id=?", (*rest, aid))
+            db.execute("DELETE FROM share_pages WHERE id=?", (aid,))
+            with _share_lock:
+                _share_lru.pop(aid, None)
+            self._count("analyses", "replaced")
+        elif self.on_conflict == "rename":
+            self._insert_fresh(db, _IMPORT_ANALYSIS, rest)
+            self._count("analyses", "renamed")
+        else:
+            self._count("analyses", "skipped")
+
+    def parse(self, obj: dict):
+        """Validate one decoded line and queue it. Raises ValueError for a bad row."""
+        kind = obj.get("type")
+        if kind == "project":
+            pid, name = obj.get("id"), obj.get("name")
+            if not isinstance(pid, str) or not _ID_RE.fullmatch(pid):
+                raise ValueError("project id must be 1-64 letters, digits, '_' or '-'")
+            if not isinstance(name, str) or not name.strip():
+                raise ValueError("project needs a name")
+            self.add("project", (pid, name.strip(), str(obj.get("emoji") or "📁"),
+                                 _import_time(obj.get("created_at"))))
+        elif kind == "image":
+            digest = obj.get("hash", "")
+            if not isinstance(digest, str) or not _HASH_RE.fullmatch(digest):
+                raise ValueError("image hash must be a hex SHA-256")
+            with _get_db() as db:
+                if db.execute("SELECT 1 FROM images WHERE hash=?", (digest,)).fetchone():
+                    return self._count("images", "skipped")  # no need to decode or thumbnail it
+            raw = base64.b64decode(obj.get("data") or "", validate=True)
+            if len(raw) > MAX_BYTES:
+                raise ValueError("image too large")
+            if hashlib.sha256(raw).hexdigest() != digest:
+                raise ValueError("image hash does not match its data")
+            # the type served for it comes from the bytes, never from the file
+            rec = _image_record(raw, digest=digest)
+            if not rec:
+                raise ValueError("not a JPEG, PNG, GIF or WebP image")
+            self.add("image", rec, len(raw))
+        elif kind == "analysis":
+            aid, question, answer = obj.get("id"), obj.get("question"), obj.get("answer")
+            if not isinstance(question, str) or not isinstance(answer, str) or not question or not answer:
+                raise ValueError("analysis needs a question and an answer")
+            digest = obj.get("image_hash")
+            if digest is not None and not (isinstance(digest, str) and _HASH_RE.fullmatch(digest)):
+                raise ValueError("image_hash must be a hex SHA-256")
+            for field in ("id", "project_id"):
+                value = obj.get(field)
+                if value is not None and not (isinstance(value, str) and _ID_RE.fullmatch(value)):
+                    raise ValueError(f"{field} must be 1-64 letters, digits, '_' or '-'")
+            mode = obj.get("mode") if obj.get("mode") in _PROMPTS else "deep"
+            self.add("analysis", (aid, question, answer, mode, digest, obj.get("project_id"),
+                                  _import_time(obj.get("created_at"))))
+        elif kind not in ("meta", "end"):
+            raise ValueError(f"unknown row type {kind!r}")
+
+@app.route("/import", methods=["POST"])
+def import_ndjson():
+    """Import an NDJSON export, sent as the request body or as a multipart
+    "file". ?on_conflict= decides what happens to ids that already exist:
+    skip (default), replace, or rename (store under a new id). Bad lines are
+    reported and skipped; batches before an error stay committed.
+    """
+    if not _authed(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    on_conflict = request.args.get("on_conflict", "skip")
+    if on_conflict not in ("skip", "replace", "rename"):
+        return jsonify({"error": "on_conflict must be skip, replace or rename."}), 400
+    request.max_content_length = IMPORT_MAX_BYTES
+    if request.mimetype == "multipart/form-data":
+        f = request.files.get("file")
+        if not f:
+            return jsonify({"error": "No file provided."}), 400
+        stream = f.stream
+    else:
+        stream = io.BufferedReader(request.stream, _UPLOAD_CHUNK)  # the raw stream reads lines a byte at a time
+
+    batch = _ImportBatch(on_conflict)
+    for n, line in enumerate(stream, 1):
+        batch.summary["lines"] = n
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+            if not isinstance(obj, dict):
+                raise ValueError("expected a JSON object")
+            if obj.get("type") == "meta" and (obj.get("format") != NDJSON_FORMAT
+                                               or obj.get("version", 0) > NDJSON_VERSION):
+                # Rows of an unknown format could be misread, so stop rather than skip
+                batch.flush()
+                return jsonify({"error": f"Unsupported export format {obj.get('format')!r} "
+                                         f"version {obj.get('version')!r}.", **batch.summary}), 400
+            batch.parse(obj)
+        except (ValueError, TypeError) as exc:
+            batch.error(n, str(exc))
+    batch.flush()
+    return jsonify(batch.summary)
 
 # ── Routes: batch ──────────────────────────────────────────────────────────────
 
-@app.route("/batch", methods=["POST"])
-def batch():
-    if not _authed(request):
-        return jsonify({"error": "Unauthorized"}), 401
+def _batch_items():
+    """Validate every upload in the current /batch request, in order.
 
-    files     = request.files.getlist("images")
-    questions = request.form.getlist("questions")  # one per image, or one shared
-    mode      = request.form.get("mode", "deep")
+    Returns (items, mode, project_id, error_response). Each item is a dict with
+    filename plus either question/stream/mime/hash/key or a per-image error.
+    Uploads stay spooled; workers read them one at a time.
+    """
+    files      = request.files.getlist("images")
+    questions  = request.form.getlist("questions")  # one per image, or one shared
+    mode       = request.form.get("mode", "deep")
     project_id = request.form.get("project_id")
-    shared_q  = request.form.get("question", "")  # fallback if per-image questions not provided
+    shared_q   = request.form.get("question", "")  # fallback if per-image questions not provided
 
     if not files:
-        return jsonify({"error": "No images provided."}), 400
+        return None, mode, project_id, (jsonify({"error": "No images provided."}), 400)
 
-    results = []
+    items = []
     for i, f in enumerate(files):
         q = (questions[i] if i < len(questions) else None) or shared_q
         if not q:
-            results.append({"error": "No question for image.", "filename": f.filename})
+            items.append({"error": "No question for image.", "filename": f.filename})
             continue
-
-        raw, mime, err = _validate_image(f)
+        _, mime, err = _check_upload(f)
         if err:
-            results.append({"error": err[0].get_json()["error"], "filename": f.filename})
+            items.append({"error": err[0].get_json()["error"], "filename": f.filename})
             continue
+        digest = _hash_upload(f)
+        items.append({"filename": f.filename, "question": q, "stream": f.stream, "mime": mime,
+                      "hash": digest, "key": _cache_key(digest, q, mode)})
+    return items, mode, project_id, None
+
+def _batch_limited():
+    """Charge this request's images to the caller's per-minute budget.
+
+    A request larger than the whole budget could never pass, so it gets a 413
+    naming the cap instead of an endless 429.
+    """
+    n = len(request.files.getlist("images")) or 1
+    if n > BATCH_RATE_LIMIT:
+        return jsonify({"error": f"At most {BATCH_RATE_LIMIT} images per request. "
+                                 "Split the upload, or send async=1 to run it as a background job."}), 413
+    if _is_limited("batch", _client_ip(request), BATCH_RATE_LIMIT, n):
+        return jsonify({"error": "Rate limit exceeded. Wait a moment."}), 429
+    return None
+
+def _item_bytes(item) -> bytes:
+    if "raw" in item:
+        return item["raw"]
+    item["stream"].seek(0)
+    return item["stream"].read()
 
-        data_url = f"data:{mime};base64,{base64.b64encode(raw).decode()}"
+def _ensure_image(raw: bytes, item):
+    """Add a batch item's image to the images table unless it is already there."""
+    with _get_db() as db:
+        if db.execute("SELECT 1 FROM images WHERE hash=?", (item["hash"],)).fetchone():
+            return
+    rec = _image_record(raw, item["mime"], digest=item["hash"])
+    with _get_db() as db:
+        _store_images(db, [rec])
+
+def _batch_one(ai, mode, item, bypass=False):
+    """Answer one batch item (from the cache when possible) and store its image.
+
+    The upload is read only while this runs, so a batch holds at most
+    BATCH_CONCURRENCY images in memory. Returns the answer text.
+    """
+    raw = _item_bytes(item)
+    answer = None if bypass else _cache_get(item["key"])
+    if answer is None:
+        flight, leader = _flight_join(item["key"], "batch", bypass)
         try:
-            resp = _get_client(request).chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": _PROMPTS.get(mode, _PROMPTS["deep"])},
-                    {"role": "user", "content": [
-                        {"type": "image_url", "image_url": {"url": data_url, "detail": "high"}},
-                        {"type": "text", "text": q},
-                    ]},
-                ],
-                max_tokens=_MAX_TOKENS.get(mode, 1500),
-                timeout=60,
-            )
-            answer = resp.choices[0].message.content
-            sid    = secrets.token_hex(4)
-            img_b64_thumb = base64.b64encode(raw[:1024*50]).decode() if len(raw) <= 1024*50 else None
-            with _get_db() as db:
-                db.execute("INSERT INTO analyses VALUES (?,?,?,?,?,?,?)",
-                           (sid, q, answer, mode, img_b64_thumb, project_id, int(time.time())))
-            results.append({"id": sid, "filename": f.filename, "question": q, "answer": answer})
-        except Exception as exc:
-            results.append({"error": str(exc), "filename": f.filename})
+            if leader:
+                try:
+                    answer = _batch_call(ai, mode, item["question"], raw, item["mime"])
+                    _cache_put(item["key"], answer)
+                except Exception as exc:
+                    flight.finish(error=str(exc))
+                    raise
+                flight.finish(answer=answer)
+            else:
+                for _ in flight.follow():
+                    pass
+                if flight.error:
+                    raise RuntimeError(flight.error)
+                answer = flight.answer
+        finally:
+            flight.leave()
+    _ensure_image(raw, item)
+    return answer
+
+def _batch_call(ai, mode, question, raw, mime):
+    """One non-streaming upstream call. Returns the answer text."""
+    img, mime, detail = _prepare_image(raw, mime, mode)
+    kwargs = dict(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": _PROMPTS.get(mode, _PROMPTS["deep"])},
+            {"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": _data_url(img, mime), "detail": detail}},
+                {"type": "text", "text": question},
+            ]},
+        ],
+        max_tokens=_MAX_TOKENS.get(mode, 1500),
+        timeout=_upstream_timeout(mode, False),
+    )
+    start = time.perf_counter()
+    try:
+        resp = _with_retries("batch", lambda: ai.chat.completions.create(**kwargs), breaker=_breaker_for(ai))
+    except Exception as exc:
+        _inc("forma_upstream_errors_total", call="batch", type=type(exc).__name__)
+        raise
+    _observe("forma_upstream_seconds", time.perf_counter() - start, call="batch")
+    return resp.choices[0].message.content
+
+def _batch_run(ai, items, mode, project_id, bypass=False):
+    """Yield (index, result, row) as each item finishes.
+
+    At most BATCH_CONCURRENCY upstream calls are in flight. ``row`` is the
+    analyses tuple to insert, or None for failed items. Closing the generator
+    early cancels any calls that have not started yet.
+    """
+    pool = ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, max(len(items), 1)))
+    try:
+        pending = {}
+        for i, item in enumerate(items):
+            if "error" in item:
+                yield i, item, None
+                continue
+            pending[pool.submit(_batch_one, ai, mode, item, bypass)] = i
+        for fut in as_completed(pending):
+            i, item = pending[fut], items[pending[fut]]
+            try:
+                answer = fut.result()
+            except Exception as exc:
+                yield i, {"error": str(exc), "filename": item["filename"]}, None
+                continue
+            sid = secrets.token_hex(4)
+            row = (sid, item["question"], answer, mode, item["hash"], project_id, int(time.time()))
+            yield i, {"id": sid, "filename": item["filename"], "question": item["question"],
+                      "answer": answer}, row
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _batch_insert(rows):
+    """Insert completed batch rows in a single transaction (images are already stored)."""
+    if not rows:
+        return
+    with _get_db() as db:
+        db.executemany(_ANALYSIS_INSERT, rows)
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    if not _authed(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    if request.form.get("async", "").lower() in ("1", "true"):
+        return _job_create()
+    limited = _batch_limited()
+    if limited:
+        return limited
+
+    items, mode, project_id, err = _batch_items()
+    if err:
+        return err
+
+    results, rows = [None] * len(items), []
+    bypass = _cache_bypassed(request)
+    for i, result, row in _batch_run(_get_client(request), items, mode, project_id, bypass):
+        results[i] = result
+        if row:
+            rows.append(row)
+    _batch_insert(rows)
 
     return jsonify({"results": results, "count": len(results)})
 
+@app.route("/batch/stream", methods=["POST"])
+def batch_stream():
+    """SSE variant of /batch: emits each image's result as soon as it completes."""
+    if not _authed(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    limited = _batch_limited()
+    if limited:
+        return limited
+
+    items, mode, project_id, err = _batch_items()
+    if err:
+        return err
+
+    ai     = _get_client(request)
+    bypass = _cache_bypassed(request)
+
+    # The request's spooled files are closed once this view returns, so the
+    # stream works from copies it owns (still on disk above _UPLOAD_CHUNK).
+    for item in items:
+        if "stream" in item:
+            own = tempfile.SpooledTemporaryFile(max_size=_UPLOAD_CHUNK)
+            shutil.copyfileobj(item["stream"], own, _UPLOAD_CHUNK)
+            item["stream"] = own
+
+    def _stream():
+        rows = []
+        try:
+            for i, result, row in _batch_run(ai, items, mode, project_id, bypass):
+                if row:
+                    rows.append(row)
+                yield f"data: {json.dumps({'index': i, **result})}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            # Persist whatever finished, even if the client went away mid-batch
+            _batch_insert(rows)
+            for item in items:
+                if "stream" in item:
+                    item["stream"].close()
+
+    return Response(stream_with_context(_stream()), mimetype="text/event-stream",
+                    headers=SSE_HEADERS)
+
+# ── Batch jobs ─────────────────────────────────────────────────────────────────
+
+# /batch with async=1 persists every upload (images go to the images table)
+# and returns a job id at once. Items are claimed one at a time by a
+# background pool, retried with backoff up to JOB_MAX_ATTEMPTS, and any
+# unfinished items are picked up again when the server restarts. A sweeper
+# thread also requeues items whose lease ran out while this process was up
+# (a worker that died mid-item, or a queue lost with another process). Each
+# finished item gets the job's next seq number so progress streams can
+# follow along with a simple "seq > last" query.
+#
+# A job sent with X-OpenAI-Key records the key's hash, never the key. Its
+# items only run on that key: after a restart, or in another worker, they
+# wait until a request carrying the same key (GET /jobs/<id>, its events, or
+# a retry) binds it again. They never fall back to the server key.
+
+_job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="forma-job")
+_job_clients: dict = {}  # job id -> the caller's OpenAI client; only the key hash is persisted
+_job_depth  = {"queued": 0, "running": 0}  # items on _job_pool, for /metrics
+_job_depth_lock = threading.Lock()
+_job_local: set = set()  # (job id, idx) waiting on _job_pool, so sweeps don't queue them twice
+_job_sweeper = None
+
+def _job_submit(jid, idx):
+    with _job_depth_lock:
+        _job_depth["queued"] += 1
+        _job_local.add((jid, idx))
+    _job_pool.submit(_job_tracked, jid, idx)
+
+def _job_tracked(jid, idx):
+    with _job_depth_lock:
+        _job_depth["queued"]  -= 1
+        _job_depth["running"] += 1
+        _job_local.discard((jid, idx))
+    try:
+        _job_work(jid, idx)
+    finally:
+        with _job_depth_lock:
+            _job_depth["running"] -= 1
+
+def _job_create():
+    if _is_limited("jobs", _client_ip(request), RATE_LIMIT):
+        return jsonify({"error": "Rate limit exceeded. Wait a moment."}), 429
+
+    files      = request.files.getlist("images")
+    questions  = request.form.getlist("questions")
+    mode       = request.form.get("mode", "deep")
+    project_id = request.form.get("project_id")
+    shared_q   = request.form.get("question", "")
+    if not files:
+        return jsonify({"error": "No images provided."}), 400
+
+    jid, now, items, rejected = secrets.token_hex(6), int(time.time()), [], 0
+    for i, f in enumerate(files):
+        q = (questions[i] if i < len(questions) else None) or shared_q
+        raw, mime, err = _validate_image(f) if q else (None, None, None)
+        if not q or err:
+            # Rejected uploads are finished from the start, so they take the first seq numbers
+            rejected += 1
+            error = err[0].get_json()["error"] if err else "No question for image."
+            items.append((jid, i, f.filename, q, None, "rejected", error, rejected))
+            continue
+        rec = _image_record(raw, mime, thumb=False)  # the worker makes the thumbnail
+        del raw
+        with _get_db() as db:  # one short write per image, so other writers aren't held up
+            _store_images(db, [rec])
+        items.append((jid, i, f.filename, q, rec[0], "pending", None, None))
+    key_hash = _request_key_hash(request)
+    with _get_db() as db:
+        db.execute("INSERT INTO jobs (id,mode,project_id,total,pending,failed,seq,created_at,key_hash) "
+                   "VALUES (?,?,?,?,?,?,?,?,?)",
+                   (jid, mode, project_id, len(items), len(items) - rejected, rejected, rejected, now, key_hash))
+        db.executemany("INSERT INTO job_items (job_id,idx,filename,question,image_hash,status,error,seq) "
+                       "VALUES (?,?,?,?,?,?,?,?)", items)
+
+    if key_hash:
+        _job_clients[jid] = _get_client(request)
+    for it in items:
+        if it[5] == "pending":
+            _job_submit(jid, it[1])
+    return jsonify({"job_id": jid, "total": len(items), "rejected": rejected,
+                    "status_url": f"/jobs/{jid}", "events_url": f"/jobs/{jid}/events"}), 202
+
+def _job_client(jid, key_hash):
+    """The client a job's items run on, or None while its caller's key is unbound here."""
+    return _job_clients.get(jid) if key_hash else client
+
+def _job_work(jid, idx):
+    """Claim one pending item, run it, and record the outcome."""
+    with _get_db() as db:
+        job = db.execute("SELECT key_hash FROM jobs WHERE id=?", (jid,)).fetchone()
+    ai = job and _job_client(jid, job["key_hash"])
+    if not ai:
+        return  # left pending until _job_bind sees the caller's key again
+    with _get_db() as db:
+        claimed = db.execute("UPDATE job_items SET status='running', attempts=attempts+1, claimed_at=? "
+                             "WHERE job_id=? AND idx=? AND status='pending'",
+                             (time.time(), jid, idx)).rowcount
+        row = claimed and db.execute(
+            "SELECT i.question, i.attempts, i.image_hash, im.data, im.mime, j.mode, j.project_id "
+            "FROM job_items i JOIN jobs j ON j.id = i.job_id JOIN images im ON im.hash = i.image_hash "
+            "WHERE i.job_id=? AND i.idx=?", (jid, idx)).fetchone()
+    if not row:
+        return
+    item = {"question": row["question"], "raw": row["data"], "mime": row["mime"], "hash": row["image_hash"],
+            "key": _cache_key(row["image_hash"], row["question"], row["mode"])}
+    try:
+        answer = _batch_one(ai, row["mode"], item)
+    except Exception as exc:
+        if row["attempts"] < JOB_MAX_ATTEMPTS:
+            with _get_db() as db:
+                db.execute("UPDATE job_items SET status='pending', error=? WHERE job_id=? AND idx=?",
+                           (str(exc), jid, idx))
+            delay = 2 ** row["attempts"] + secrets.randbelow(1000) / 1000
+            timer = threading.Timer(delay, _job_submit, (jid, idx))
+            timer.daemon = True
+            timer.start()
+        else:
+            _job_finish(jid, idx, error=str(exc))
+        return
+    sid = secrets.token_hex(4)
+    _job_finish(jid, idx, analysis=(sid, row["question"], answer, row["mode"], row["image_hash"],
+                                    row["project_id"], int(time.time())),
+                thumb=(row["image_hash"], _make_thumb(row["data"])))
+
+def _job_finish(jid, idx, analysis=None, error=None, thumb=None):
+    with _get_db(immediate=True) as db:
+        if analysis:
+            db.execute(_ANALYSIS_INSERT, analysis)
+        if thumb and thumb[1]:
+            db.execute("UPDATE images SET thumb=? WHERE hash=? AND thumb IS NULL", (thumb[1], thumb[0]))
+        db.execute(f"UPDATE jobs SET seq=seq+1, pending=pending-1, {'failed=failed+1' if error else 'done=done+1'} "
+                   "WHERE id=?", (jid,))
+        job = db.execute("SELECT seq, pending FROM jobs WHERE id=?", (jid,)).fetchone()
+        db.execute("UPDATE job_items SET status=?, analysis_id=?, error=?, seq=? WHERE job_id=? AND idx=?",
+                   ("error" if error else "done", analysis and analysis[0], error, job["seq"], jid, idx))
+        if job["pending"] == 0:
+            db.execute("UPDATE jobs SET finished_at=? WHERE id=?", (int(time.time()), jid))
+    if job["pending"] == 0:
+        _job_clients.pop(jid, None)
+
+def _job_resume(stale_only=False):
+    """Requeue items running past their lease, and pending items nobody here has queued.
+
+    At startup every pending item is taken over. Later sweeps only take pending
+    items untouched for a whole lease, which another process may have dropped.
+    """
+    expired = time.time() - JOB_LEASE
+    with _get_db() as db:
+        db.execute("UPDATE job_items SET status='pending' WHERE status='running' AND claimed_at < ?",
+                   (expired,))
+        rows = db.execute("SELECT i.job_id, i.idx, j.key_hash FROM job_items i JOIN jobs j ON j.id = i.job_id "
+                          "WHERE i.status='pending' AND COALESCE(i.claimed_at, j.created_at) < ?",
+                          (expired if stale_only else float("inf"),)).fetchall()
+    with _job_depth_lock:
+        rows = [r for r in rows if (r["job_id"], r["idx"]) not in _job_local
+                and _job_client(r["job_id"], r["key_hash"])]  # caller-key jobs wait for _job_bind
+    for r in rows:
+        _job_submit(r["job_id"], r["idx"])
+
+def _job_requeue(jid):
+    """Queue a job's pending items that aren't already queued here."""
+    with _get_db() as db:
+        rows = db.execute("SELECT idx FROM job_items WHERE job_id=? AND status='pending'", (jid,)).fetchall()
+    with _job_depth_lock:
+        rows = [r for r in rows if (jid, r["idx"]) not in _job_local]
+    for r in rows:
+        _job_submit(jid, r["idx"])
+
+def _job_bind(jid, key_hash, req):
+    """Rebind a caller-key job to the request's client if it carries the same key,
+    and queue the items that were waiting for it.
+    """
+    if not key_hash or jid in _job_clients or _request_key_hash(req) != key_hash:
+        return
+    _job_clients[jid] = _get_client(req)
+    _job_requeue(jid)
+
+def _job_sweep():
+    stale_only = False
+    while True:
+        try:
+            _job_resume(stale_only)
+            stale_only = True
+        except sqlite3.Error:
+            pass  # busy or locked; the next sweep tries again
+        time.sleep(JOB_SWEEP)
+
+def _job_start():
+    """Start the lease sweeper once per process.
+
+    Called when the server starts (python app.py, or ASGI lifespan startup),
+    and on the first request under any other server. Never at import, so a
+    preloading server doesn't fork with a borrowed connection or live threads.
+    """
+    global _job_sweeper
+    with _job_depth_lock:
+        if _job_sweeper:
+            return
+        _job_sweeper = threading.Thread(target=_job_sweep, name="forma-job-sweep", daemon=True)
+    _job_sweeper.start()
+
+def _job_status(jid, req=None):
+    """A job's progress, or None. Passing the request lets it rebind a caller-key job."""
+    with _get_db() as db:
+        job = db.execute("SELECT id,mode,project_id,total,pending,done,failed,created_at,finished_at,key_hash "
+                         "FROM jobs WHERE id=?", (jid,)).fetchone()
+    if not job:
+        return None
+    job = dict(job)
+    key_hash = job.pop("key_hash")
+    if req is not None and job["pending"]:
+        _job_bind(jid, key_hash, req)
+    status = "running"
+    if job["pending"] == 0:
+        status = "done"
+    elif not _job_client(jid, key_hash):
+        status = "waiting_for_key"
+    return {**job, "status": status}
+
+_JOB_ITEM_SELECT = ("SELECT i.idx AS \"index\", i.filename, i.question, i.status, i.error, i.seq, "
+                    "i.analysis_id AS id, a.answer FROM job_items i "
+                    "LEFT JOIN analyses a ON a.id = i.analysis_id WHERE i.job_id=?")
+
+# ── Routes: jobs ───────────────────────────────────────────────────────────────
+
+@app.route("/jobs/<jid>")
+def job_status(jid):
+    if not _authed(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    job = _job_status(jid, request)
+    if not job:
+        return jsonify({"error": "Job not found."}), 404
+    if request.args.get("items"):
+        with _get_db() as db:
+            job["items"] = [dict(r) for r in db.execute(_JOB_ITEM_SELECT + " ORDER BY i.idx", (jid,))]
+    return jsonify(job)
+
+@app.route("/jobs/<jid>/events")
+def job_events(jid):
+    """SSE stream of finished items (same shape as /batch/stream) plus progress updates."""
+    if not _authed(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    if not _job_status(jid, request):
+        return jsonify({"error": "Job not found."}), 404
+    after = request.args.get("after", 0, type=int)
+
+    def _stream():
+        last = after
+        while True:
+            # Status first: if it says done, every finish is already visible to the item query
+            job = _job_status(jid)
+            with _get_db() as db:
+                rows = db.execute(_JOB_ITEM_SELECT + " AND i.seq > ? ORDER BY i.seq LIMIT 200",
+                                  (jid, last)).fetchall()
+            for r in rows:
+                last = r["seq"]
+                item = {k: r[k] for k in r.keys() if r[k] is not None and k != "seq"}
+                yield f"data: {json.dumps(item)}\n\n"
+            yield f"data: {json.dumps({'progress': job, 'seq': last})}\n\n"
+            if job["status"] == "done" and not rows:
+                yield "data: [DONE]\n\n"
+                return
+            if not rows:
+                time.sleep(1)
+
+    return Response(stream_with_context(_stream()), mimetype="text/event-stream",
+                    headers=SSE_HEADERS)
+
+@app.route("/jobs/<jid>/retry", methods=["POST"])
+def job_retry(jid):
+    """Requeue every item of a job that failed after exhausting its attempts."""
+    if not _authed(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    # The retrying caller's key (or the server key) runs the job from here on
+    key_hash = _request_key_hash(request)
+    with _get_db(immediate=True) as db:
+        if not db.execute("UPDATE jobs SET key_hash=? WHERE id=?", (key_hash, jid)).rowcount:
+            return jsonify({"error": "Job not found."}), 404
+        rows = db.execute("SELECT idx FROM job_items WHERE job_id=? AND status='error'", (jid,)).fetchall()
+        if rows:
+            db.execute("UPDATE job_items SET status='pending', attempts=0, error=NULL, seq=NULL "
+                       "WHERE job_id=? AND status='error'", (jid,))
+            db.execute("UPDATE jobs SET pending=pending+?, failed=failed-?, finished_at=NULL WHERE id=?",
+                       (len(rows), len(rows), jid))
+    if key_hash:
+        _job_clients[jid] = _get_client(request)
+    else:
+        _job_clients.pop(jid, None)
+    _job_requeue(jid)
+    return jsonify({"ok": True, "retried": len(rows)})
+
+@app.before_request
+def _job_start_once():
+    if not _job_sweeper:
+        _job_start()
+
+# ── Analyze helpers ────────────────────────────────────────────────────────────
+
+# Shared by the Flask /analyze route below and the async one in asgi.py.
+
+def _analysis_messages(data_url: str, detail: str, question: str, mode: str, turns: list) -> list:
+    """Chat messages for an /analyze call; the image rides on the first user turn."""
+    msgs = [{"role": "system", "content": _PROMPTS[mode]}]
+    first = turns[0]["text"] if turns else question
+    msgs.append({"role": "user", "content": [
+        {"type": "image_url", "image_url": {"url": data_url, "detail": detail}},
+        {"type": "text",      "text": first},
+    ]})
+    if turns:
+        for t in turns[1:]:
+            msgs.append({"role": t["role"], "content": t["text"]})
+        msgs.append({"role": "user", "content": question})
+    return msgs
+
+def _stream_rate(first, chunks: int):
+    """Record tokens/sec for a finished stream, measured from its first token."""
+    _inc("forma_analyze_tokens_total", chunks)
+    if first is not None and chunks > 1:
+        _observe("forma_analyze_tokens_per_second", (chunks - 1) / (time.perf_counter() - first))
+
+def _analyze_drive(flight, ai, msgs: list, mode: str):
+    """Run the streaming upstream call for a flight, publishing tokens as they
+    arrive. Runs on its own thread so it outlives the request that started it.
+    """
+    stream, started, first = None, time.perf_counter(), None
+    budget = _BUDGETS[mode]
+    try:
+        stream, chunks = _open_stream(ai, mode, msgs, stop=lambda: flight.abandoned)
+        for chunk in chunks:
+            if flight.abandoned:
+                return flight.finish(error="Cancelled.")
+            if time.perf_counter() - started > budget:
+                raise TimeoutError(f"The answer took longer than the {budget:.0f}s {mode} budget.")
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first is None:
+                    first = time.perf_counter()
+                    _observe("forma_analyze_ttft_seconds", first - started)
+                flight.publish(delta)
+        _stream_rate(first, len(flight.parts))
+        answer = "".join(flight.parts)
+        if answer:
+            _cache_put(flight.key, answer)
+        flight.finish(answer=answer)
+    except Exception as exc:
+        _inc("forma_upstream_errors_total", call="analyze", type=type(exc).__name__)
+        if stream is not None and _retryable(exc):
+            _breaker_for(ai).failure()  # failed mid-stream, after _open_stream counted a success
+        flight.finish(error=_upstream_error(exc))
+    finally:
+        if stream is not None:
+            stream.close()  # stops the upstream generation if abandoned
+
+def _upstream_error(exc: Exception) -> str:
+    """User-facing message for a failed upstream call."""
+    msg = str(exc)
+    if "api_key" in msg.lower() or "authentication" in msg.lower():
+        msg = "Invalid or missing OpenAI API key."
+    elif "quota" in msg.lower() or "billing" in msg.lower():
+        msg = "OpenAI quota exceeded."
+    return msg
+
+# ── Conversation sessions ──────────────────────────────────────────────────────
+
+# The first /analyze of a conversation returns X-Forma-Session. Follow-ups send
+# session_id instead of the image and history: the image is read from the
+# image store by hash, turns are appended server-side and the oldest ones are
+# dropped past SESSION_MAX_TOKENS. Sessions expire SESSION_TTL seconds after
+# their last turn.
+
+PREPARED_SIZE = 32  # upstream-ready image copies kept in memory
+
+_prepared: OrderedDict = OrderedDict()  # (image hash, detail) -> (data, mime, detail)
+_prepared_lock = threading.Lock()
+
+def _approx_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def _trim_turns(turns: list):
+    """Drop the oldest question/answer pairs until the history fits. Returns (turns, tokens)."""
+    tokens = sum(_approx_tokens(t["text"]) for t in turns)
+    while tokens > SESSION_MAX_TOKENS and len(turns) > 2:
+        tokens -= _approx_tokens(turns[0]["text"]) + _approx_tokens(turns[1]["text"])
+        turns = turns[2:]
+    return turns, tokens
+
+def _session_load(sid: str):
+    """The session row (image_hash, turns, ...), or None if unknown or expired."""
+    with _get_db() as db:
+        return db.execute("SELECT * FROM sessions WHERE id=? AND updated_at>=?",
+                          (sid, int(time.time()) - SESSION_TTL)).fetchone()
+
+def _session_image(image_hash: str, mode: str, raw: bytes = None, mime: str = None):
+    """_prepare_image for a stored image, memoized so follow-ups skip the read and re-encode.
+
+    Returns (data, mime, detail), or None if the image is gone. raw/mime seed the
+    memo for a fresh upload that is not in the image store yet.
+    """
+    memo = (image_hash, _IMAGE_DETAIL.get(mode, "high"))
+    with _prepared_lock:
+        if memo in _prepared:
+            _prepared.move_to_end(memo)
+            return _prepared[memo]
+    if raw is None:
+        with _get_db() as db:
+            row = db.execute("SELECT mime, data FROM images WHERE hash=?", (image_hash,)).fetchone()
+        if not row:
+            return None
+        raw, mime = row["data"], row["mime"]
+    prepared = _prepare_image(raw, mime, mode)
+    with _prepared_lock:
+        _prepared[memo] = prepared
+        while len(_prepared) > PREPARED_SIZE:
+            _prepared.popitem(last=False)
+    return prepared
+
+def _session_append(sid: str, question: str, answer: str, start=None):
+    """Append a question/answer pair to a session.
+
+    start=(image hash, raw, mime, prior turns) creates the session and stores its image.
+    """
+    now    = int(time.time())
+    pair   = [{"role": "user", "text": question}, {"role": "assistant", "text": answer}]
+    record = _image_record(start[1], start[2], digest=start[0]) if start else None  # thumbnail outside the write lock
+    with _get_db(immediate=True) as db:
+        if start:
+            db.execute("DELETE FROM sessions WHERE updated_at<?", (now - SESSION_TTL,))
+            _store_images(db, [record])
+            turns, tokens = _trim_turns(start[3] + pair)
+            db.execute("INSERT INTO sessions (id, image_hash, turns, tokens, created_at, updated_at) "
+                       "VALUES (?,?,?,?,?,?)", (sid, start[0], json.dumps(turns), tokens, now, now))
+            return
+        row = db.execute("SELECT turns FROM sessions WHERE id=?", (sid,)).fetchone()
+        if row:
+            turns, tokens = _trim_turns(json.loads(row["turns"]) + pair)
+            db.execute("UPDATE sessions SET turns=?, tokens=?, updated_at=? WHERE id=?",
+                       (json.dumps(turns), tokens, now, sid))
+
+# ── Routes: sessions ───────────────────────────────────────────────────────────
+
+@app.route("/sessions/<sid>")
+def get_session(sid):
+    if not _authed(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    row = _session_load(sid)
+    if not row:
+        return jsonify({"error": "Session not found or expired."}), 404
+    return jsonify({"id": row["id"], "image_hash": row["image_hash"], "turns": json.loads(row["turns"]),
+                    "tokens": row["tokens"], "created_at": row["created_at"],
+                    "expires_at": row["updated_at"] + SESSION_TTL})
+
+@app.route("/sessions/<sid>", methods=["DELETE"])
+def delete_session(sid):
+    if not _authed(request):
+        return jsonify({"error": "Unauthorized"}), 401
+    with _get_db() as db:
+        db.execute("DELETE FROM sessions WHERE id=?", (sid,))
+    return jsonify({"ok": True})
+
 # ── Routes: analyze (streaming) ───────────────────────────────────────────────
 
 @app.route("/analyze", methods=["POST"])
@@ -503,14 +2962,24 @@ def analyze():
     if not _authed(request):
         return jsonify({"error": "Unauthorized.", "auth": True}), 401
 
-    ip = (request.headers.get("X-Forwarded-For","") or request.remote_addr or "").split(",")[0].strip()
-    if _is_limited(ip):
+    if _is_limited("analyze", _client_ip(request), RATE_LIMIT):
         return jsonify({"error": "Rate limit exceeded. Wait a moment."}), 429
-
-    f = request.files.get("image")
-    raw, mime, err = _validate_image(f)
-    if err:
-        return err
+    # Reject oversized bodies from the header, before the upload is received and spooled
+    if (request.content_length or 0) > MAX_BYTES + 1024 * 1024:
+        return jsonify({"error": "Image too large (max 20 MB)."}), 413
+
+    f   = request.files.get("image")
+    sid = request.form.get("session_id", "").strip()
+    raw = mime = start = None
+    if sid and not f:
+        sess = _session_load(sid)
+        if not sess:
+            return jsonify({"error": "Session not found or expired."}), 404
+        image_hash, turns = sess["image_hash"], json.loads(sess["turns"])
+    else:
+        raw, mime, err = _validate_image(f)
+        if err:
+            return err
 
     question = request.form.get("question", "").strip()
     if not question:
@@ -520,53 +2989,75 @@ def analyze():
     if mode not in _PROMPTS:
         mode = "deep"
 
-    data_url = f"data:{mime};base64,{base64.b64encode(raw).decode()}"
-    turns    = json.loads(request.form.get("history", "[]"))
-
-    if turns:
-        msgs = [{"role": "system", "content": _PROMPTS[mode]}]
-        msgs.append({"role": "user", "content": [
-            {"type": "image_url", "image_url": {"url": data_url, "detail": "high"}},
-            {"type": "text",      "text": turns[0]["text"]},
-        ]})
-        for t in turns[1:]:
-            msgs.append({"role": t["role"], "content": t["text"]})
-        msgs.append({"role": "user", "content": question})
-    else:
-        msgs = [
-            {"role": "system", "content": _PROMPTS[mode]},
-            {"role": "user", "content": [
-                {"type": "image_url", "image_url": {"url": data_url, "detail": "high"}},
-                {"type": "text",      "text": question},
-            ]},
-        ]
-
-    ai = _get_client(request)
-
-    def _stream():
+    if raw is not None:
+        # A new upload starts a new session; it is stored once the first answer is in
+        image_hash = hashlib.sha256(raw).hexdigest()
+        turns = json.loads(request.form.get("history", "[]"))
+        sid   = secrets.token_hex(16)
+        start = (image_hash, raw, mime, turns)
+    key = _cache_key(image_hash, question, mode, turns)
+
+    bypass = _cache_bypassed(request)
+    cached = None if bypass else _cache_get(key)
+    if cached is not None:
+        _session_append(sid, question, cached, start)
+        return Response(_cache_replay(cached), mimetype="text/event-stream",
+                        headers={**SSE_HEADERS, "X-Forma-Cache": "HIT", "X-Forma-Session": sid})
+
+    # Identical requests already in flight share its answer (see _Flight);
+    # only the leader prepares the image and calls upstream
+    flight, leader = _flight_join(key, "analyze", bypass)
+    sent, ai = 0, _get_client(request)
+    breaker = _breaker_for(ai)
+    if leader and breaker.is_open():
+        msg = str(_circuit_open_error(breaker))
+        flight.finish(error=msg)
+        flight.leave()
+        return jsonify({"error": msg}), 503, {"Retry-After": str(breaker.retry_after())}
+    if leader:
         try:
-            stream = ai.chat.completions.create(
-                model="gpt-4o", messages=msgs,
-                max_tokens=_MAX_TOKENS[mode], stream=True, timeout=60,
-            )
-            for chunk in stream:
-                delta = chunk.choices[0].delta.content
-                if delta:
-                    yield f"data: {json.dumps({'token': delta})}\n\n"
-            yield "data: [DONE]\n\n"
-        except Exception as exc:
-            msg = str(exc)
-            if "api_key" in msg.lower() or "authentication" in msg.lower():
-                msg = "Invalid or missing OpenAI API key."
-            elif "quota" in msg.lower() or "billing" in msg.lower():
-                msg = "OpenAI quota exceeded."
-            yield f"data: {json.dumps({'error': msg})}\n\n"
+            prepared = _session_image(image_hash, mode, raw, mime)
+        except Exception:
+            flight.finish(error="Could not read the image.")
+            flight.leave()
+            raise
+        if prepared is None:
+            flight.finish(error="Session image not found.")
+            flight.leave()
+            return jsonify({"error": "Session image not found."}), 404
+        img, img_mime, detail = prepared
+        sent = len(img)
+        msgs = _analysis_messages(_data_url(img, img_mime), detail, question, mode, turns)
+        threading.Thread(target=_analyze_drive, args=(flight, ai, msgs, mode),
+                         name="forma-flight", daemon=True).start()
 
-    return Response(stream_with_context(_stream()), mimetype="text/event-stream",
-                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    def _stream():
+        for tok in flight.follow():
+            yield f"data: {json.dumps({'token': tok})}\n\n"
+        if flight.error:
+            yield f"data: {json.dumps({'error': flight.error})}\n\n"
+            return
+        if flight.answer:
+            _session_append(sid, question, flight.answer, start)
+        yield "data: [DONE]\n\n"
+
+    # Image bytes are <uploaded>/<sent>; uploaded is 0 when the image came from
+    # the session, sent is 0 when the request joined another one in flight
+    status = "BYPASS" if bypass else "MISS" if leader else "JOINED"
+    resp = Response(stream_with_context(_stream()), mimetype="text/event-stream",
+                    headers={**SSE_HEADERS, "X-Forma-Cache": status, "X-Forma-Session": sid,
+                             "X-Forma-Image-Bytes": f"{len(raw) if raw else 0}/{sent}"})
+    # Leave when the response is closed, not in the generator: a client that
+    # disconnects before the first chunk closes a generator that never started,
+    # so its finally block would not run. The last subscriber to leave stops
+    # the upstream generation.
+    resp.call_on_close(flight.leave)
+    return resp
 
 
 if __name__ == "__main__":
     port  = int(os.environ.get("PORT", 5001))
     debug = os.environ.get("FLASK_DEBUG", "false").lower() == "true"
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":  # not in the reloader's watcher
+        _job_start()
     app.run(debug=debug, port=port, threaded=True)
@@ -0,0 +1,379 @@
+"""Async serving mode for Forma.
+
+Serves POST /analyze natively on asyncio with AsyncOpenAI, so an SSE stream
+costs a coroutine rather than a worker thread for the whole generation, and
+hands every other route to the Flask app in app.py. Run with:
+
+    uvicorn asgi:app --port 5001
+
+The event protocol is the same as the Flask route: data: {"token": ...}
+lines, then data: [DONE], or data: {"error": ...}. If the client goes away
+mid-stream the upstream request is cancelled.
+"""
+import os, json, time, asyncio, hashlib, itertools, secrets, tempfile
+from types import SimpleNamespace
+from werkzeug.datastructures import FileStorage, Headers
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from a2wsgi import WSGIMiddleware
+
+import app as forma
+
+WSGI_THREADS = int(os.environ.get("FORMA_WSGI_THREADS", 16))  # threads for routes served by Flask
+_FORM_LIMIT  = 1024 * 1024  # text fields (question, history), bytes
+
+_flask = WSGIMiddleware(forma.app, workers=WSGI_THREADS)
+
+# Same arrangement as app.py: one shared async connection pool, per-key clients in an LRU
+_ahttp    = DefaultAsyncHttpxClient(limits=forma._HTTP_LIMITS, http2=forma._HTTP2)
+_aclients = forma._ClientPool(lambda key: AsyncOpenAI(api_key=key, http_client=_ahttp, max_retries=0),
+                              forma.CLIENT_POOL_SIZE, forma.CLIENT_IDLE)
+_aclient  = None
+
+def _get_client(headers):
+    """Async twin of app._get_client: per-request key from X-OpenAI-Key, else the server key."""
+    global _aclient
+    req_key = headers.get("X-OpenAI-Key", "").strip()
+    if req_key:
+        return _aclients.get(req_key)
+    if _aclient is None or _aclient.api_key != forma.client.api_key:
+        _aclient = AsyncOpenAI(api_key=forma.client.api_key, http_client=_ahttp, max_retries=0)
+    return _aclient
+
+# ── ASGI plumbing ──────────────────────────────────────────────────────────────
+
+async def _send_json(send, status, obj, headers=()):
+    body = json.dumps(obj).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode()), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _read_form(receive, headers):
+    """Stream a multipart body into (fields, image). Returns (fields, image, error).
+
+    The image part goes to a spooled temp file and parsing stops as soon as it
+    passes MAX_BYTES, so an oversized upload is never buffered in full.
+    """
+    _, opts = parse_options_header(headers.get("Content-Type", ""))
+    if "boundary" not in opts:
+        return None, None, (400, {"error": "Expected multipart/form-data."})
+    decoder = MultipartDecoder(opts["boundary"].encode(), max_form_memory_size=_FORM_LIMIT)
+    fields, image, part, buf, size = {}, None, None, bytearray(), 0
+    more = True
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            if not more:
+                break
+            msg = await receive()
+            if msg["type"] == "http.disconnect":
+                return None, None, (499, {"error": "Client disconnected."})
+            more = msg.get("more_body", False)
+            if msg.get("body"):
+                decoder.receive_data(msg["body"])
+            if not more:
+                decoder.receive_data(None)
+        elif isinstance(event, File):
+            part = event
+            if event.name == "image":
+                image = FileStorage(tempfile.SpooledTemporaryFile(max_size=forma._UPLOAD_CHUNK),
+                                    filename=event.filename)
+        elif isinstance(event, Field):
+            part, buf = event, bytearray()
+        elif isinstance(event, Data):
+            if isinstance(part, File):
+                if part.name == "image":
+                    size += len(event.data)
+                    if size > forma.MAX_BYTES:
+                        return None, None, (400, {"error": "Image too large (max 20 MB)."})
+                    image.stream.write(event.data)
+            elif part is not None:
+                buf += event.data
+                if not event.more_data:
+                    fields[part.name] = buf.decode("utf-8", "replace")
+        elif isinstance(event, Epilogue):
+            break
+    if image is not None:
+        image.stream.seek(0)
+    return fields, image, None
+
+def _load_image(image):
+    """Validate and read the spooled upload, inside an app context for jsonify."""
+    try:
+        with forma.app.app_context():
+            raw, mime, err = forma._validate_image(image)
+            return raw, mime, (err[1], err[0].get_json()) if err else None
+    finally:
+        if image is not None:
+            image.close()
+
+# ── /analyze ───────────────────────────────────────────────────────────────────
+
+async def analyze(scope, receive, send):
+    headers = Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]])
+    req = SimpleNamespace(headers=headers, remote_addr=(scope.get("client") or ("",))[0])
+
+    if not forma._authed(req):
+        return await _send_json(send, 401, {"error": "Unauthorized.", "auth": True})
+    if await asyncio.to_thread(forma._is_limited, "analyze", forma._client_ip(req), forma.RATE_LIMIT):
+        return await _send_json(send, 429, {"error": "Rate limit exceeded. Wait a moment."})
+    if int(headers.get("Content-Length") or 0) > forma.MAX_BYTES + 1024 * 1024:
+        return await _send_json(send, 413, {"error": "Image too large (max 20 MB)."})
+
+    fields, image, err = await _read_form(receive, headers)
+    if err:
+        return await _send_json(send, *err)
+    sid = fields.get("session_id", "").strip()
+    raw = mime = start = None
+    if sid and image is None:
+        sess = await asyncio.to_thread(forma._session_load, sid)
+        if not sess:
+            return await _send_json(send, 404, {"error": "Session not found or expired."})
+        image_hash, turns = sess["image_hash"], json.loads(sess["turns"])
+    else:
+        raw, mime, err = await asyncio.to_thread(_load_image, image)
+        if err:
+            return await _send_json(send, *err)
+
+    question = fields.get("question", "").strip()
+    if not question:
+        return await _send_json(send, 400, {"error": "No question provided."})
+    mode = fields.get("mode", "deep")
+    if mode not in forma._PROMPTS:
+        mode = "deep"
+    if raw is not None:
+        image_hash = hashlib.sha256(raw).hexdigest()
+        turns = json.loads(fields.get("history", "[]"))
+        sid   = secrets.token_hex(16)
+        start = (image_hash, raw, mime, turns)
+    key = forma._cache_key(image_hash, question, mode, turns)
+
+    bypass = forma._cache_bypassed(req)
+    cached = None if bypass else await asyncio.to_thread(forma._cache_get, key)
+    sse = [(k.lower().encode(), v.encode()) for k, v in forma.SSE_HEADERS.items()]
+    sse.append((b"content-type", b"text/event-stream"))
+    sse.append((b"x-forma-session", sid.encode()))
+    if cached is not None:
+        await asyncio.to_thread(forma._session_append, sid, question, cached, start)
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": sse + [(b"x-forma-cache", b"HIT")]})
+        for event in forma._cache_replay(cached):
+            await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+        return await send({"type": "http.response.body", "body": b""})
+
+    # Coalesce with an identical request in flight, as the Flask route does
+    flight, leader = forma._flight_join(key, "analyze", bypass)
+    sent, ai = 0, _get_client(headers)
+    breaker = forma._breaker_for(ai)
+    if leader and breaker.is_open():
+        msg = str(forma._circuit_open_error(breaker))
+        flight.finish(error=msg)
+        flight.leave()
+        return await _send_json(send, 503, {"error": msg},
+                                [(b"retry-after", str(breaker.retry_after()).encode())])
+    if leader:
+        try:
+            prepared = await asyncio.to_thread(forma._session_image, image_hash, mode, raw, mime)
+        except Exception:
+            flight.finish(error="Could not read the image.")
+            flight.leave()
+            raise
+        if prepared is None:
+            flight.finish(error="Session image not found.")
+            flight.leave()
+            return await _send_json(send, 404, {"error": "Session image not found."})
+        img, img_mime, detail = prepared
+        sent = len(img)
+        msgs   = forma._analysis_messages(forma._data_url(img, img_mime), detail, question, mode, turns)
+        driver = asyncio.create_task(_drive(flight, ai, msgs, mode))
+        loop   = asyncio.get_running_loop()
+        flight.abort = lambda: loop.call_soon_threadsafe(driver.cancel)
+
+    status = b"BYPASS" if bypass else b"MISS" if leader else b"JOINED"
+    await send({"type": "http.response.start", "status": 200,
+                "headers": sse + [(b"x-forma-cache", status),
+                                  (b"x-forma-image-bytes", f"{len(raw) if raw else 0}/{sent}".encode())]})
+
+    async def emit(text):
+        await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+    async def produce():
+        try:
+            async for tok in _follow(flight):
+                await emit(f"data: {json.dumps({'token': tok})}\n\n")
+            if flight.error:
+                return await emit(f"data: {json.dumps({'error': flight.error})}\n\n")
+            if flight.answer:
+                await asyncio.to_thread(forma._session_append, sid, question, flight.answer, start)
+            await emit("data: [DONE]\n\n")
+        finally:
+            flight.leave()  # the last subscriber to leave cancels the driver
+
+    async def watch():
+        # The body has been read, so the next message can only be a disconnect
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    producer, watcher = asyncio.create_task(produce()), asyncio.create_task(watch())
+    done, _ = await asyncio.wait({producer, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    if watcher in done:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        return
+    watcher.cancel()
+    await send({"type": "http.response.body", "body": b""})
+
+async def _drive(flight, ai, msgs, mode):
+    """Async twin of app._analyze_drive. Cancelled when every subscriber has gone."""
+    started, first, stream = time.perf_counter(), None, None
+    budget = forma._BUDGETS[mode]
+    try:
+        stream, chunks = await _open_stream(ai, mode, msgs)
+        async for chunk in chunks:
+            if time.perf_counter() - started > budget:
+                raise TimeoutError(f"The answer took longer than the {budget:.0f}s {mode} budget.")
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first is None:
+                    first = time.perf_counter()
+                    forma._observe("forma_analyze_ttft_seconds", first - started)
+                flight.publish(delta)
+        forma._stream_rate(first, len(flight.parts))
+        answer = "".join(flight.parts)
+        if answer:
+            await asyncio.to_thread(forma._cache_put, flight.key, answer)
+        flight.finish(answer=answer)
+    except asyncio.CancelledError:
+        flight.finish(error="Cancelled.")
+        raise
+    except Exception as exc:
+        forma._inc("forma_upstream_errors_total", call="analyze", type=type(exc).__name__)
+        if stream is not None and forma._retryable(exc):
+            forma._breaker_for(ai).failure()
+        flight.finish(error=forma._upstream_error(exc))
+    finally:
+        if stream is not None:
+            await stream.close()  # closes the upstream connection if we are cancelled
+
+async def _follow(flight):
+    """Async twin of _Flight.follow. Publishes may come from other threads (/batch)."""
+    loop, ready = asyncio.get_running_loop(), asyncio.Event()
+    wake = lambda: loop.call_soon_threadsafe(ready.set)
+    flight.listen(wake)
+    try:
+        i = 0
+        while True:
+            ready.clear()
+            tokens, done = flight.tail(i)
+            i += len(tokens)
+            for tok in tokens:
+                yield tok
+            if done:
+                return
+            await ready.wait()
+    finally:
+        flight.unlisten(wake)
+
+def _timed(send):
+    """Wrap send to record request metrics for /analyze, matching the Flask after_request hook."""
+    started = time.perf_counter()
+
+    async def timed_send(msg):
+        if msg["type"] == "http.response.start":
+            forma._observe("forma_http_request_duration_seconds", time.perf_counter() - started, route="/analyze")
+            forma._inc("forma_http_requests_total", route="/analyze", method="POST", status=msg["status"])
+        await send(msg)
+    return timed_send
+
+# ── Upstream resilience ────────────────────────────────────────────────────────
+
+# Async twins of the helpers in app.py's Upstream resilience section.
+
+async def _chain(head, it):
+    for chunk in head:
+        yield chunk
+    async for chunk in it:
+        yield chunk
+
+async def _first_token(ai, kwargs):
+    started = time.perf_counter()
+    stream  = await ai.chat.completions.create(**kwargs)
+    try:
+        it, head = stream.__aiter__(), []
+        async for chunk in it:
+            head.append(chunk)
+            if chunk.choices and chunk.choices[0].delta.content:
+                with forma._upstream_lock:
+                    forma._ttft_samples.append(time.perf_counter() - started)
+                break
+        return stream, _chain(head, it)
+    except BaseException:
+        await stream.close()
+        raise
+
+async def _hedged_open(ai, kwargs):
+    after = forma._hedge_after()
+    if after is None:
+        return await _first_token(ai, kwargs)
+    tasks = [asyncio.create_task(_first_token(ai, kwargs))]
+    winner, error = None, None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=after)
+        if not done:
+            tasks.append(asyncio.create_task(_first_token(ai, kwargs)))
+            with forma._upstream_lock:
+                forma._upstream_stats["hedges"] += 1
+            forma._inc("forma_upstream_hedges_total", result="sent")
+        pending = set(tasks)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and winner is None:
+                    winner = task
+                error = error or task.exception()
+        if winner is None:
+            raise error
+        if winner is not tasks[0]:
+            with forma._upstream_lock:
+                forma._upstream_stats["hedge_wins"] += 1
+            forma._inc("forma_upstream_hedges_total", result="won")
+        return winner.result()
+    finally:
+        for task in tasks:
+            if task is not winner:
+                task.cancel()  # a cancelled _first_token closes its stream
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    await task.result()[0].close()
+
+async def _open_stream(ai, mode, msgs):
+    kwargs = dict(model="gpt-4o", messages=msgs, max_tokens=forma._MAX_TOKENS[mode],
+                  stream=True, timeout=forma._upstream_timeout(mode, True))
+    breaker = forma._breaker_for(ai)
+    if not breaker.allow():
+        raise forma._circuit_open_error(breaker)
+    for attempt in itertools.count():
+        try:
+            result = await _hedged_open(ai, kwargs)
+        except Exception as exc:
+            await asyncio.sleep(forma._upstream_attempt("analyze", attempt, exc, breaker=breaker))
+            continue
+        breaker.success()
+        return result
+
+# ── Entry point ────────────────────────────────────────────────────────────────
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                forma._job_start()
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                await _ahttp.aclose()
+                return await send({"type": "lifespan.shutdown.complete"})
+    if scope["type"] == "http" and scope["path"] == "/analyze" and scope["method"] == "POST":
+        return await analyze(scope, receive, _timed(send))
+    return await _flask(scope, receive, send)
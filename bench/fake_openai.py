@@ -0,0 +1,107 @@
+"""Local stand-in for the OpenAI chat completions API, for benchmarks.
+
+Answers POST /v1/chat/completions, streaming or not, after a fixed latency
+and at a fixed token rate, so Forma's own overhead can be measured apart
+from the model's. Point the app at it with OPENAI_BASE_URL:
+
+    python bench/fake_openai.py --port 8399 --latency 0.3 --rate 200
+    OPENAI_BASE_URL=http://127.0.0.1:8399/v1 python app.py
+"""
+import argparse, json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_WORDS = ("the room is rectangular with a door on the north wall and two windows facing east "
+          "so the area works out to about twelve square metres once the alcove is excluded").split()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    latency = 0.3                  # seconds before the first token
+    rate    = 200.0                # tokens per second after that
+    tokens  = 120                  # tokens per answer
+    calls   = 0
+    _lock   = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass  # the app dropped an idle keep-alive connection
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            return self._send(404, {"error": {"message": "not found"}})
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        with _Handler._lock:
+            _Handler.calls += 1
+        n = min(self.tokens, body.get("max_tokens") or self.tokens)
+        words = [_WORDS[i % len(_WORDS)] + " " for i in range(n)]
+        time.sleep(self.latency)
+        if body.get("stream"):
+            return self._stream(words)
+        time.sleep(n / self.rate)
+        self._send(200, {
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "".join(words)}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": n, "total_tokens": n},
+        })
+
+    def _send(self, status, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, words):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for word in words:
+                self._chunk(word)
+                time.sleep(1 / self.rate)
+            self._chunk(None)
+            self._write(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # the app cancelled the stream
+
+    def _chunk(self, content):
+        delta = {"content": content} if content is not None else {}
+        event = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                 "model": "gpt-4o", "choices": [{"index": 0, "delta": delta,
+                                                 "finish_reason": None if content is not None else "stop"}]}
+        self._write(f"data: {json.dumps(event)}\n\n".encode())
+
+    def _write(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def serve(port: int = 8399, latency: float = 0.3, rate: float = 200.0, tokens: int = 120):
+    """Start the stub on a background thread. Returns the server; call shutdown() to stop it."""
+    _Handler.latency, _Handler.rate, _Handler.tokens = latency, rate, tokens
+    server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--port",    type=int,   default=8399)
+    ap.add_argument("--latency", type=float, default=0.3, help="seconds before the first token")
+    ap.add_argument("--rate",    type=float, default=200, help="tokens per second")
+    ap.add_argument("--tokens",  type=int,   default=120, help="tokens per answer")
+    args = ap.parse_args()
+    serve(args.port, args.latency, args.rate, args.tokens)
+    print(f"fake OpenAI on http://127.0.0.1:{args.port}/v1")
+    threading.Event().wait()
@@ -0,0 +1,306 @@
+"""Benchmark Forma's own overhead against a local fake OpenAI server.
+
+    python bench/run.py                         # Flask server (python app.py)
+    python bench/run.py --server asgi           # uvicorn asgi:app
+    python bench/run.py --rows 20000 --quick    # smaller, faster run
+
+Seeds a throwaway database with --rows analyses, starts the app on it with
+OPENAI_BASE_URL pointing at bench/fake_openai.py, and measures /analyze time to
+first token under increasing concurrency, /batch throughput, /search and
+/projects latency and PDF export time. All timings are in seconds and are
+written as one JSON document (default bench/results/<commit>-<server>.json),
+so two runs can be diffed.
+"""
+import argparse, hashlib, json, os, platform, random, sqlite3, struct, subprocess, sys, tempfile, time, uuid, zlib
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_openai
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_WORDS = ("wall door window stair column beam roof floor plan section room corridor area angle "
+          "triangle circle square rectangle polygon perimeter length width height scale north").split()
+
+
+# ── Fixtures ───────────────────────────────────────────────────────────────────
+
+def _png(width: int, height: int, seed: int) -> bytes:
+    """A deterministic noisy RGB PNG (about 3 bytes per pixel), built with the standard library."""
+    rnd  = random.Random(seed)
+    rows = b"".join(b"\0" + rnd.randbytes(width * 3) for _ in range(height))
+    chunk = lambda tag, data: (struct.pack(">I", len(data)) + tag + data +
+                               struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b""))
+
+
+def _multipart(fields: list) -> tuple:
+    """Encode [(name, value)] or [(name, (filename, bytes))] as multipart/form-data."""
+    boundary = uuid.uuid4().hex
+    out = []
+    for name, value in fields:
+        if isinstance(value, tuple):
+            out.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                       f'filename="{value[0]}"\r\nContent-Type: image/png\r\n\r\n'.encode() + value[1] + b"\r\n")
+        else:
+            out.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    out.append(f"--{boundary}--\r\n".encode())
+    return b"".join(out), f"multipart/form-data; boundary={boundary}"
+
+
+def seed(db_path: str, rows: int, projects: int, image: bytes) -> dict:
+    """Create the schema through app.py, then bulk-insert analyses. Returns ids to query."""
+    env = {**os.environ, "FORMA_DB_PATH": db_path, "OPENAI_API_KEY": "sk-bench"}
+    subprocess.run([sys.executable, "-c", "import app"], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    rnd, now = random.Random(42), int(time.time())
+    digest = hashlib.sha256(image).hexdigest()
+    pids = [uuid.uuid4().hex[:8] for _ in range(projects)]
+    db = sqlite3.connect(db_path)
+    with db:
+        db.execute("INSERT OR IGNORE INTO images VALUES (?,?,?,?,?)", (digest, "image/png", image, None, now))
+        db.executemany("INSERT INTO projects (id,name,emoji,created_at,last_activity) VALUES (?,?,?,?,?)",
+                       [(pid, f"Project {i}", "📁", now - i, now - i) for i, pid in enumerate(pids)])
+        db.executemany(
+            "INSERT INTO analyses (id,question,answer,mode,image_hash,project_id,created_at) VALUES (?,?,?,?,?,?,?)",
+            ((f"{i:08x}", " ".join(rnd.choices(_WORDS, k=8)) + "?",
+              " ".join(rnd.choices(_WORDS, k=120)), rnd.choice(("quick", "deep", "expert")),
+              digest, pids[i % projects], now - rows + i) for i in range(rows)))
+        pdf_pid = uuid.uuid4().hex[:8]
+        db.execute("INSERT INTO projects (id,name,emoji,created_at,last_activity) VALUES (?,?,?,?,?)",
+                   (pdf_pid, "PDF", "📄", now, now))
+        db.executemany(
+            "INSERT INTO analyses (id,question,answer,mode,image_hash,project_id,created_at) VALUES (?,?,?,?,?,?,?)",
+            ((f"pdf{i:05x}", "What is the area?", " ".join(rnd.choices(_WORDS, k=300)),
+              "deep", digest, pdf_pid, now + i) for i in range(25)))
+        aid = db.execute("SELECT id FROM analyses WHERE project_id=? LIMIT 1", (pdf_pid,)).fetchone()[0]
+    db.close()
+    return {"projects": pids, "pdf_project": pdf_pid, "analysis": aid}
+
+
+# ── Server ─────────────────────────────────────────────────────────────────────
+
+def start_app(kind: str, port: int, env: dict):
+    if kind == "asgi":
+        cmd = [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port), "--log-level", "warning"]
+    else:
+        cmd = [sys.executable, "app.py"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env={**env, "PORT": str(port)},
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            if _get(port, "/ping")[0] == 200:
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"app did not start on port {port}")
+
+
+def _get(port: int, path: str, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        conn.request("GET", path, headers=headers or {})
+        resp = conn.getresponse()
+        return resp.status, resp.read(), resp.getheader("X-Next-Cursor")
+    finally:
+        conn.close()
+
+
+# ── Measurements ───────────────────────────────────────────────────────────────
+
+def _summary(samples: list) -> dict:
+    if not samples:
+        return {"n": 0}
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s) - 1, int(q * len(s)))]
+    return {"n": len(s), "mean": round(sum(s) / len(s), 5), "p50": round(pick(0.5), 5),
+            "p95": round(pick(0.95), 5), "max": round(s[-1], 5)}
+
+
+def _timed_get(port: int, path: str, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        status, _, _ = _get(port, path)
+        if status != 200:
+            raise RuntimeError(f"GET {path} returned {status}")
+        samples.append(time.perf_counter() - start)
+    return _summary(samples)
+
+
+def analyze_once(port: int, body: bytes, ctype: str, n: int):
+    """One /analyze stream. Returns (ttft, total) or None on error."""
+    headers = {"Content-Type": ctype, "X-Forma-Cache": "bypass",
+               "X-Forwarded-For": f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}"}  # one rate-limit key each
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    start, ttft = time.perf_counter(), None
+    try:
+        conn.request("POST", "/analyze", body=body, headers=headers)
+        resp = conn.getresponse()
+        if resp.status != 200:
+            return None
+        for line in resp:
+            if ttft is None and line.startswith(b'data: {"token"'):
+                ttft = time.perf_counter() - start
+            elif line.startswith(b'data: {"error"'):
+                return None
+            elif line.startswith(b"data: [DONE]"):
+                break
+        return (ttft, time.perf_counter() - start) if ttft is not None else None
+    except OSError:
+        return None
+    finally:
+        conn.close()
+
+
+def bench_analyze(port: int, image: bytes, levels: list, per_worker: int, latency: float) -> dict:
+    out, counter = {}, iter(range(1, 10 ** 9))
+    for level in levels:
+        bodies = [_multipart([("image", ("plan.png", image)), ("question", f"What is the area? #{i}"),
+                              ("mode", "deep")]) for i in range(level * per_worker)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as pool:
+            results = list(pool.map(lambda b: analyze_once(port, *b, next(counter)), bodies))
+        wall = time.perf_counter() - start
+        ok = [r for r in results if r]
+        ttft = _summary([r[0] for r in ok])
+        out[str(level)] = {"requests": len(results), "errors": len(results) - len(ok),
+                           "wall": round(wall, 4), "req_per_s": round(len(ok) / wall, 3),
+                           "ttft": ttft, "total": _summary([r[1] for r in ok]),
+                           "ttft_overhead_p50": round(ttft["p50"] - latency, 5) if ok else None}
+    return out
+
+
+def bench_batch(port: int, image: bytes, images: int, repeat: int) -> dict:
+    samples, n = [], 0
+    for r in range(repeat):
+        fields = [("images", (f"{i}.png", image)) for i in range(images)]
+        fields += [("questions", f"Run {r} image {i}: what is the area?") for i in range(images)]
+        body, ctype = _multipart(fields + [("mode", "quick")])
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+        start = time.perf_counter()
+        conn.request("POST", "/batch", body=body,
+                     headers={"Content-Type": ctype, "X-Forma-Cache": "bypass", "X-Forwarded-For": f"10.99.0.{r}"})
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+        if resp.status == 200:
+            samples.append(time.perf_counter() - start)
+            n += images
+    wall = _summary(samples)
+    return {"images_per_request": images, "wall": wall,
+            "images_per_s": round(n / sum(samples), 3) if samples else None}
+
+
+def bench_search(port: int, repeat: int) -> dict:
+    out = {}
+    for q in ("door", "window area", "tri", "perimeter scale north"):
+        out[f"q={q}"] = _timed_get(port, f"/search?q={q.replace(' ', '+')}&limit=50", repeat)
+    out["newest"] = _timed_get(port, "/search?limit=50", repeat)
+    # Keyset paging: follow X-Next-Cursor through 10 pages
+    samples, cursor = [], ""
+    for _ in range(10):
+        start = time.perf_counter()
+        _, _, cursor = _get(port, f"/search?q=door&limit=50&cursor={cursor or ''}")
+        samples.append(time.perf_counter() - start)
+        if not cursor:
+            break
+    out["paged"] = _summary(samples)
+    return out
+
+
+def bench_projects(port: int, ids: dict, repeat: int) -> dict:
+    return {"list": _timed_get(port, "/projects", repeat),
+            "analyses": _timed_get(port, f"/projects/{ids['projects'][0]}/analyses", repeat)}
+
+
+def bench_pdf(port: int, ids: dict, repeat: int) -> dict:
+    """The first export of each PDF renders it ("cold"); later ones may be served from the cache."""
+    out = {}
+    for name, path in (("single", f"/export/{ids['analysis']}/pdf"),
+                       ("project_25", f"/projects/{ids['pdf_project']}/export/pdf")):
+        out[name] = {"cold": _timed_get(port, path, 1), "repeat": _timed_get(port, path, repeat)}
+    return out
+
+
+# ── Main ───────────────────────────────────────────────────────────────────────
+
+def _git(*args) -> str:
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark Forma against a local fake OpenAI server.")
+    ap.add_argument("--server",  choices=("flask", "asgi"), default="flask")
+    ap.add_argument("--port",    type=int,   default=5099)
+    ap.add_argument("--rows",    type=int,   default=100_000, help="seeded analyses")
+    ap.add_argument("--projects", type=int,  default=50)
+    ap.add_argument("--levels",  default="1,8,32,64", help="/analyze concurrency levels")
+    ap.add_argument("--per-worker", type=int, default=4, help="/analyze requests per concurrent client")
+    ap.add_argument("--latency", type=float, default=0.3, help="fake upstream latency before first token, s")
+    ap.add_argument("--rate",    type=float, default=200, help="fake upstream tokens per second")
+    ap.add_argument("--tokens",  type=int,   default=120, help="fake upstream tokens per answer")
+    ap.add_argument("--repeat",  type=int,   default=20, help="samples per latency measurement")
+    ap.add_argument("--quick",   action="store_true", help="fewer samples and levels, for a smoke run")
+    ap.add_argument("--out",     help="output JSON path")
+    args = ap.parse_args()
+    if args.quick:
+        args.levels, args.per_worker, args.repeat = "1,8", 2, 5
+
+    sha = _git("rev-parse", "--short", "HEAD") or "unknown"
+    out_path = args.out or os.path.join(ROOT, "bench", "results", f"{sha}-{args.server}.json")
+    work = tempfile.mkdtemp(prefix="forma-bench-")
+    db_path = os.path.join(work, "forma.db")
+    image = _png(1024, 768, 7)
+
+    fake = fake_openai.serve(0, args.latency, args.rate, args.tokens)
+    env = {**os.environ, "OPENAI_API_KEY": "sk-bench", "FORMA_PASSWORD": "", "FLASK_DEBUG": "false",
+           "FORMA_PDF_CACHE": os.path.join(work, "pdf"),
+           "OPENAI_BASE_URL": f"http://127.0.0.1:{fake.server_address[1]}/v1",
+           "FORMA_DB_PATH": db_path, "FORMA_BATCH_RATE_LIMIT": "1000000000"}
+
+    start = time.perf_counter()
+    ids = seed(db_path, args.rows, args.projects, image)
+    seed_time = time.perf_counter() - start
+    print(f"seeded {args.rows} analyses in {seed_time:.1f}s", file=sys.stderr)
+
+    proc = start_app(args.server, args.port, env)
+    try:
+        results = {}
+        for name, run in (
+            ("analyze",  lambda: bench_analyze(args.port, image, [int(x) for x in args.levels.split(",")],
+                                               args.per_worker, args.latency)),
+            ("batch",    lambda: bench_batch(args.port, image, 16, max(2, args.repeat // 5))),
+            ("search",   lambda: bench_search(args.port, args.repeat)),
+            ("projects", lambda: bench_projects(args.port, ids, args.repeat)),
+            ("pdf",      lambda: bench_pdf(args.port, ids, max(2, args.repeat // 5))),
+        ):
+            print(f"running {name}", file=sys.stderr)
+            results[name] = run()
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        fake.shutdown()
+
+    doc = {
+        "meta": {"commit": sha, "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+                 "server": args.server, "python": platform.python_version(), "platform": platform.platform(),
+                 "time": int(time.time()), "rows": args.rows, "projects": args.projects,
+                 "image_bytes": len(image), "seed_seconds": round(seed_time, 2),
+                 "fake": {"latency": args.latency, "rate": args.rate, "tokens": args.tokens,
+                          "calls": fake_openai._Handler.calls}},
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, "w") as fh:
+        json.dump(doc, fh, indent=2, sort_keys=True)
+    print(out_path)
+
+
+if __name__ == "__main__":
+    main()
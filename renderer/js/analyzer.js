@@ -9,6 +9,7 @@ const Analyzer = (() => {
   let _fullText = '';
   let _tokenCount = 0;
   let _history = [];   // conversation turns [{role,text}]
+  let _session = null; // server-side session for follow-ups on the un-annotated image
 
   // ── State helpers ────────────────────────────────────────────────────────
 
@@ -39,6 +40,7 @@ const Analyzer = (() => {
     if (!file) return;
     _file = file;
     _history = [];
+    _session = null;
 
     const reader = new FileReader();
     reader.onload = e => {
@@ -77,6 +79,7 @@ const Analyzer = (() => {
   function reset() {
     _file     = null;
     _history  = [];
+    _session  = null;
     _savedId  = null;
     _savedUrl = null;
     _fullText = '';
@@ -139,6 +142,8 @@ const Analyzer = (() => {
         question: q,
         mode: _mode,
         history: _history,
+        session: annBlob ? null : _session,
+        onSession: (id) => { _session = annBlob ? null : id; },
         onToken: (tok) => {
           // Switch from skeleton to response on first token
           if (document.getElementById('skel-wrap').style.display !== 'none') {
@@ -258,15 +263,12 @@ const Analyzer = (() => {
     const q   = document.getElementById('question').value.trim();
     const pid = document.getElementById('project-select').value || null;
 
-    // Thumbnail: first 50KB of image base64
+    // Full image; the server dedupes it by content hash and makes the thumbnail
     let imgB64 = null;
     try {
       const reader = new FileReader();
       imgB64 = await new Promise(res => {
-        reader.onload = e => {
-          const b64 = e.target.result.split(',')[1];
-          res(b64.slice(0, 1024 * 68)); // ~50KB
-        };
+        reader.onload = e => res(e.target.result.split(',')[1]);
         reader.readAsDataURL(_file);
       });
     } catch {}
@@ -116,6 +116,11 @@ const API = (() => {
     return r.json();
   }
 
+  async function getAnalysis(aid) {
+    const r = await fetch(`${base()}/analyses/${encodeURIComponent(aid)}`, { headers: headers() });
+    return r.json();
+  }
+
   async function moveAnalysis(aid, project_id) {
     const r = await fetch(`${base()}/analyses/${aid}/move`, {
       method: 'PATCH', headers: headers(),
@@ -128,18 +133,29 @@ const API = (() => {
   function projectPdfUrl(pid) { return `${base()}/projects/${pid}/export/pdf`; }
 
   // Streaming analyze
-  async function analyze({ imageFile, question, mode, history = [], onToken, onError }) {
+  // With a session id only the question is sent; the server keeps the image and turns.
+  async function analyze({ imageFile, question, mode, history = [], session = null, onSession, onToken, onError }) {
     if (_electron) await getPort();
     const fd = new FormData();
-    fd.append('image',    imageFile);
+    if (session) {
+      fd.append('session_id', session);
+    } else {
+      fd.append('image',    imageFile);
+      fd.append('history',  JSON.stringify(history));
+    }
     fd.append('question', question);
     fd.append('mode',     mode);
-    fd.append('history',  JSON.stringify(history));
 
     const res = await fetch(`${base()}/analyze`, {
       method: 'POST', headers: multipartHeaders(), body: fd
     });
 
+    // Expired session: start a new one from the full upload
+    if (res.status === 404 && session) {
+      return analyze({ imageFile, question, mode, history, onSession, onToken, onError });
+    }
+    if (res.ok && onSession) onSession(res.headers.get('X-Forma-Session'));
+
     if (!res.ok) {
       const err = await res.json().catch(() => ({ error: `HTTP ${res.status}` }));
       onError(err.error || 'Request failed');
@@ -198,7 +214,7 @@ const API = (() => {
     init, setPassword, setApiKey, getApiKey,
     ping, stats, auth,
     search, save, getProjects, createProject, deleteProject,
-    updateProject, projectAnalyses, moveAnalysis,
+    updateProject, projectAnalyses, getAnalysis, moveAnalysis,
     exportPdfUrl, projectPdfUrl,
     analyze, batch, saveConfig,
     get pw()   { return _pw; },
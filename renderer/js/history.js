@@ -30,24 +30,29 @@ const History = (() => {
       return;
     }
     list.innerHTML = items.map(item => `
-      <div class="h-item" onclick="History.load(${JSON.stringify(JSON.stringify(item))})">
+      <div class="h-item" data-id="${_esc(item.id)}">
         <div class="h-item-top">
-          <span class="h-mode">${item.mode}</span>
+          <span class="h-mode">${_esc(item.mode)}</span>
           <span class="h-time">${_ago(item.created_at)}</span>
         </div>
         <div class="h-q">${_esc(item.question)}</div>
-        <div class="h-a">${_esc(item.answer.slice(0, 80))}</div>
+        <div class="h-a">${_esc(item.excerpt.slice(0, 80))}</div>
       </div>
     `).join('');
+    list.querySelectorAll('.h-item').forEach(el => {
+      el.addEventListener('click', () => load(el.dataset.id));
+    });
   }
 
-  function load(itemJson) {
-    const item = typeof itemJson === 'string' ? JSON.parse(itemJson) : itemJson;
+  async function load(id) {
+    // List rows only carry an excerpt; fetch the full answer
+    const item = await API.getAnalysis(id);
+    if (item.error) return;
     // Switch to analyzer view and show result
     App.showView('analyzer');
     // Show the saved analysis in the output panel
     const rb = document.getElementById('resp-body');
-    rb.innerHTML = item.answer.replace(
+    rb.innerHTML = _esc(item.answer).replace(
       /^(Step\s+\d+[:.)]?|\d+[.)]\s)/gm,
       '<span class="step-num">$1</span>'
     );
@@ -94,7 +99,8 @@ const History = (() => {
   }
 
   function _esc(s) {
-    return String(s).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;');
+    return String(s).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;')
+                    .replace(/"/g,'&quot;').replace(/'/g,'&#39;');
   }
 
   return { filterMode, search, render, load, refresh, exportAll, clearAll };